@@ -1,13 +1,242 @@
-from typing import Dict
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional
 
-import resend
+from starlette.concurrency import run_in_threadpool
 
-def send_mail(to:[str], subject:str, html:str) -> Dict:
-    params: resend.Emails.SendParams = {
-        "from": "welcome@jwt.knollfear.com",
+from metrics import GaugeFunc, Histogram
+
+MAIL_FROM = "welcome@jwt.knollfear.com"
+RESEND_API_KEY = os.environ.get("RESEND_API_KEY")
+MAIL_QUEUE_SIZE = int(os.environ.get("MAIL_QUEUE_SIZE", "1000"))
+MAIL_WORKERS = int(os.environ.get("MAIL_WORKERS", "2"))
+MAIL_BATCH_SIZE = int(os.environ.get("MAIL_BATCH_SIZE", "100"))  # Resend's batch limit
+MAIL_BATCH_WAIT = float(os.environ.get("MAIL_BATCH_WAIT", "0.05"))
+MAIL_MAX_RETRIES = int(os.environ.get("MAIL_MAX_RETRIES", "3"))
+MAIL_RETRY_BACKOFF = float(os.environ.get("MAIL_RETRY_BACKOFF", "0.5"))
+
+EMAIL_SEND_SECONDS = Histogram("email_send_seconds", "Time per batch send attempt to the mail provider", ("outcome",))
+
+
+def _resend():
+    # Imported on first send rather than at startup: resend pulls in requests
+    import resend
+
+    if resend.api_key is None:
+        resend.api_key = RESEND_API_KEY
+    return resend
+
+
+def build_mail(to:[str], subject:str, html:str) -> Dict:
+    params: "resend.Emails.SendParams" = {
+        "from": MAIL_FROM,
         "to": to,
         "subject": subject,
         "html": html,
     }
-    email: resend.Email = resend.Emails.send(params)
-    return email
\ No newline at end of file
+    return params
+
+
+def send_mail(to:[str], subject:str, html:str) -> Dict:
+    """Send one email right away (blocking). Request handlers should use `mail_queue.submit`."""
+    email: "resend.Email" = _resend().Emails.send(build_mail(to, subject, html))
+    return email
+
+
+class MailRejected(Exception):
+    """The provider refused the message(s) as invalid; sending them again won't help."""
+
+
+class ResendTransport:
+    """Delivers messages through Resend, using the batch endpoint when there is more than one."""
+
+    def send_batch(self, messages: List[Dict]) -> None:
+        resend = _resend()
+        try:
+            if len(messages) == 1:
+                resend.Emails.send(messages[0])
+            else:
+                resend.Batch.send(messages)
+        except resend.exceptions.ResendError as e:
+            # 4xx other than 429 is a validation or auth failure, not a transient one
+            code = str(e.code)
+            if code.isdigit() and 400 <= int(code) < 500 and code != "429":
+                raise MailRejected(str(e)) from e
+            raise
+
+
+class MailQueueFull(Exception):
+    pass
+
+
+class MailQueue:
+    """
+    In-process outbound mail queue.
+
+    `submit` only enqueues, so request handlers never wait on the mail
+    provider. Worker tasks (started on first use) drain the queue in batches
+    of up to `batch_size`, retrying failed batches with exponential backoff.
+    A batch the provider rejects outright (`MailRejected`, e.g. one invalid
+    address) is not retried but sent again one message at a time, so only
+    the bad messages are lost. The transport is anything with a `send_batch(messages)` method, plain or
+    async; blocking transports run in the threadpool.
+    """
+
+    def __init__(
+        self,
+        transport,
+        max_size: int = MAIL_QUEUE_SIZE,
+        workers: int = MAIL_WORKERS,
+        batch_size: int = MAIL_BATCH_SIZE,
+        batch_wait: float = MAIL_BATCH_WAIT,
+        max_retries: int = MAIL_MAX_RETRIES,
+        retry_backoff: float = MAIL_RETRY_BACKOFF,
+    ):
+        self.transport = transport
+        self.max_size = max_size
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        self.enqueued = 0
+        self.rejected = 0
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.batches = 0
+        self.split = 0
+        self.high_water = 0
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    def full(self) -> bool:
+        return self._queue is not None and self._queue.full()
+
+    def submit(self, message: Dict) -> None:
+        """Enqueue a message without waiting. Raises `MailQueueFull` when at capacity."""
+        self.start()
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise MailQueueFull(f"Mail queue is full ({self.max_size} pending)")
+        self.enqueued += 1
+        self.high_water = max(self.high_water, self._queue.qsize())
+
+    def start(self) -> None:
+        if self._tasks:
+            return
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.max_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Give pending messages up to `timeout` seconds to go out, then stop the workers."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print("Mail queue stopped with", self._queue.qsize(), "messages unsent")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _next_batch(self) -> List[Dict]:
+        batch = [await self._queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _attempt(self, batch: List[Dict]) -> bool:
+        """Send `batch`, retrying transient errors; raises `MailRejected` straight away."""
+        for attempt in range(self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                if asyncio.iscoroutinefunction(self.transport.send_batch):
+                    await self.transport.send_batch(batch)
+                else:
+                    await run_in_threadpool(self.transport.send_batch, batch)
+            except MailRejected:
+                EMAIL_SEND_SECONDS.observe(time.perf_counter() - start, "rejected")
+                raise
+            except Exception as e:
+                EMAIL_SEND_SECONDS.observe(time.perf_counter() - start, "error")
+                if attempt == self.max_retries:
+                    print("Error sending", len(batch), "emails, giving up:", e)
+                    return False
+                self.retries += 1
+                await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+            else:
+                EMAIL_SEND_SECONDS.observe(time.perf_counter() - start, "ok")
+                return True
+
+    async def _deliver(self, batch: List[Dict]) -> List[bool]:
+        try:
+            ok = await self._attempt(batch)
+        except MailRejected as e:
+            if len(batch) == 1:
+                print("Email rejected by the provider:", e)
+                self.failed += 1
+                return [False]
+            # The provider validates a batch as a unit: find the bad messages by sending one at a time
+            self.split += 1
+            results = []
+            for message in batch:
+                results.extend(await self._deliver([message]))
+            return results
+
+        if ok:
+            self.sent += len(batch)
+            self.batches += 1
+        else:
+            self.failed += len(batch)
+        return [ok] * len(batch)
+
+    async def send(self, batch: List[Dict]) -> List[bool]:
+        """
+        Deliver `batch` now, bypassing the queue, with the same retries,
+        fallback and counters. Returns whether each message went out, in
+        order. For callers that need to know the outcome, like bulk logins.
+        """
+        return await self._deliver(batch)
+
+    async def _worker(self) -> None:
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._deliver(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_size": self.max_size,
+            "high_water": self.high_water,
+            "enqueued": self.enqueued,
+            "rejected": self.rejected,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "batches": self.batches,
+            "split": self.split,
+        }
+
+
+mail_queue = MailQueue(ResendTransport())
+GaugeFunc("mail_queue", "Mail queue depth, capacity and lifetime counters",
+          mail_queue.stats, ("stat",))
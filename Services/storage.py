@@ -0,0 +1,125 @@
+import time
+from datetime import datetime
+from typing import Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from metrics import Histogram
+
+S3_CALL_SECONDS = Histogram("s3_call_seconds", "Time per S3 call, including the wait for a threadpool slot", ("op",))
+
+
+async def _timed(op: str, fn, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return await run_in_threadpool(fn, *args, **kwargs)
+    finally:
+        S3_CALL_SECONDS.observe(time.perf_counter() - start, op)
+
+
+class S3Storage:
+    """
+    Async wrapper around the S3 calls made by the login flow.
+
+    boto3 and requests are blocking, so every call runs in Starlette's
+    threadpool instead of on the event loop. Both clients keep a pool of
+    keep-alive connections, so consecutive logins reuse sockets rather than
+    paying a new TLS handshake each time. boto3 and requests are only
+    imported, and the clients built, on first use, which keeps them out of
+    the app's cold start.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        endpoint_url: Optional[str] = None,
+        aws_access_key_id: Optional[str] = None,
+        aws_secret_access_key: Optional[str] = None,
+        max_connections: int = 20,
+    ):
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self.aws_access_key_id = aws_access_key_id
+        self.aws_secret_access_key = aws_secret_access_key
+        self.max_connections = max_connections
+        self._client = None
+        self._session = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            from botocore.config import Config
+
+            self._client = boto3.client(
+                's3',
+                endpoint_url=self.endpoint_url,
+                aws_access_key_id=self.aws_access_key_id,
+                aws_secret_access_key=self.aws_secret_access_key,
+                config=Config(max_pool_connections=self.max_connections),
+            )
+        return self._client
+
+    @property
+    def session(self):
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    @property
+    def errors(self) -> tuple:
+        """Exceptions meaning S3 couldn't be reached or refused a call, for `except storage.errors:`."""
+        import requests
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        return ClientError, BotoCoreError, requests.RequestException
+
+    def connect(self) -> None:
+        """Import boto3 and requests and build both clients now (blocking)."""
+        self.client, self.session
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def put(self, key: str, body: bytes, content_type: str, expires: datetime):
+        return await _timed(
+            "put",
+            self.client.put_object,
+            Bucket=self.bucket,
+            Key=key,
+            Body=body,
+            ContentType=content_type,
+            Expires=expires,
+        )
+
+    async def presign(self, key: str, expires_in: int) -> str:
+        return await _timed(
+            "presign",
+            self.client.generate_presigned_url,
+            "get_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": key,
+            },
+            ExpiresIn=expires_in,
+        )
+
+    async def delete(self, key: str):
+        return await _timed("delete", self.client.delete_object, Bucket=self.bucket, Key=key)
+
+    async def fetch(self, url: str, timeout: float = 5) -> Tuple[int, bytes]:
+        """GET a (presigned) URL, returning the status code and body."""
+        response = await _timed("fetch", self.session.get, url, timeout=timeout)
+        return response.status_code, response.content
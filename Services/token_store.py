@@ -0,0 +1,268 @@
+import base64
+import hashlib
+import heapq
+import json
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from cryptography.fernet import Fernet, InvalidToken
+from starlette.concurrency import run_in_threadpool
+
+from Services.storage import S3Storage
+from sqlite_local import LocalConnection
+
+
+class LoginTokenStoreError(Exception):
+    """The store could not be reached; distinct from a missing or expired token."""
+
+
+class LoginTokenStore:
+    """
+    Holds a signed login token between `request_login` and `proxy_jwt`.
+
+    `put` stores a token for `ttl` seconds and returns the path (and query
+    string, if any) of the magic link. `take` hands the token back at most
+    once, or returns None if it is unknown, expired or already used.
+    """
+
+    async def put(self, request_id: str, token: str, ttl: int) -> str:
+        raise NotImplementedError
+
+    async def take(self, request_id: str, query_string: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def open(self) -> None:
+        """Build clients ahead of the first request; called when the app starts."""
+
+    async def close(self) -> None:
+        """Release connections; called when the app shuts down."""
+
+    @staticmethod
+    def link_path(request_id: str) -> str:
+        return f"/jwt/{request_id}.jwt"
+
+
+class MemoryLoginTokenStore(LoginTokenStore):
+    """Process-local store. Only suitable when a single worker serves both the form and the link."""
+
+    def __init__(self):
+        self._tokens: Dict[str, Tuple[float, str]] = {}
+
+    async def put(self, request_id: str, token: str, ttl: int) -> str:
+        now = time.time()
+        self._sweep(now)
+        self._tokens[request_id] = (now + ttl, token)
+        return self.link_path(request_id)
+
+    async def take(self, request_id: str, query_string: str) -> Optional[str]:
+        entry = self._tokens.pop(request_id, None)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+
+    def _sweep(self, now: float) -> None:
+        expired = [key for key, (expires_at, _) in self._tokens.items() if expires_at <= now]
+        for key in expired:
+            del self._tokens[key]
+
+
+class SQLiteLoginTokenStore(LoginTokenStore):
+    """
+    SQLite-backed store in WAL mode, so every Hypercorn worker on a host can
+    share one database file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connect = LocalConnection(path)
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS login_tokens ("
+                " request_id TEXT PRIMARY KEY,"
+                " token TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+
+    def _put(self, request_id: str, token: str, ttl: int) -> None:
+        now = time.time()
+        db = self._connect()
+        db.execute("DELETE FROM login_tokens WHERE expires_at <= ?", (now,))
+        db.execute(
+            "INSERT OR REPLACE INTO login_tokens (request_id, token, expires_at) VALUES (?, ?, ?)",
+            (request_id, token, now + ttl),
+        )
+
+    def _take(self, request_id: str) -> Optional[str]:
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT token, expires_at FROM login_tokens WHERE request_id = ?", (request_id,)
+            ).fetchone()
+            if row is not None:
+                db.execute("DELETE FROM login_tokens WHERE request_id = ?", (request_id,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+        if row is None or row[1] <= time.time():
+            return None
+        return row[0]
+
+    async def put(self, request_id: str, token: str, ttl: int) -> str:
+        try:
+            await run_in_threadpool(self._put, request_id, token, ttl)
+        except sqlite3.Error as e:
+            raise LoginTokenStoreError(str(e)) from e
+        return self.link_path(request_id)
+
+    async def take(self, request_id: str, query_string: str) -> Optional[str]:
+        try:
+            return await run_in_threadpool(self._take, request_id)
+        except sqlite3.Error as e:
+            raise LoginTokenStoreError(str(e)) from e
+
+
+class S3LoginTokenStore(LoginTokenStore):
+    """
+    The original flow: the token is uploaded as `<uuid>.jwt` and the magic
+    link carries the presigned query string, which `take` replays against
+    `public_base`. The object is deleted once fetched.
+    """
+
+    def __init__(self, storage: S3Storage, public_base: str):
+        self.storage = storage
+        self.public_base = public_base
+
+    async def put(self, request_id: str, token: str, ttl: int) -> str:
+        object_key = f"{request_id}.jwt"
+        try:
+            await self.storage.put(
+                object_key,
+                token.encode("utf-8"),  # bytes
+                content_type="application/jwt",  # optional but nice
+                expires=datetime.now() + timedelta(seconds=ttl),
+            )
+            presigned = await self.storage.presign(object_key, expires_in=ttl)
+        except self.storage.errors as e:
+            raise LoginTokenStoreError(str(e)) from e
+
+        # We only need the query string part (all the X-Amz-* params, etc.)
+        return f"{self.link_path(request_id)}?{urlparse(presigned).query}"
+
+    async def take(self, request_id: str, query_string: str) -> Optional[str]:
+        if not query_string:
+            return None
+
+        object_key = f"{request_id}.jwt"
+        try:
+            status_code, content = await self.storage.fetch(f"{self.public_base}/{object_key}?{query_string}", timeout=5)
+        except self.storage.errors as e:
+            raise LoginTokenStoreError(str(e)) from e
+
+        if status_code != 200:
+            # S3 will return 403/400/etc if the signature is invalid or expired
+            return None
+
+        try:
+            await self.storage.delete(object_key)
+        except self.storage.errors as e:
+            # The object still expires on its own
+            print("Error deleting used login token:", e)
+
+        return content.decode("utf-8")
+
+    async def open(self) -> None:
+        await run_in_threadpool(self.storage.connect)
+
+    async def close(self) -> None:
+        self.storage.close()
+
+
+class MemoryNonceSet:
+    """Consumed grant nonces for this worker, each forgotten once its grant has expired."""
+
+    def __init__(self):
+        self._nonces: Set[str] = set()
+        self._expiry: List[Tuple[float, str]] = []
+
+    async def consume(self, nonce: str, expires_at: float) -> bool:
+        """True the first time `nonce` is seen, False on every replay."""
+        now = time.time()
+        while self._expiry and self._expiry[0][0] <= now:
+            self._nonces.discard(heapq.heappop(self._expiry)[1])
+        if nonce in self._nonces:
+            return False
+        self._nonces.add(nonce)
+        heapq.heappush(self._expiry, (expires_at, nonce))
+        return True
+
+
+class SQLiteNonceSet:
+    """Consumed grant nonces in a WAL-mode database, shared by every worker on the host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connect = LocalConnection(path)
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS consumed_grants ("
+                " nonce TEXT PRIMARY KEY,"
+                " expires_at REAL NOT NULL)"
+            )
+
+    def _consume(self, nonce: str, expires_at: float) -> bool:
+        db = self._connect()
+        db.execute("DELETE FROM consumed_grants WHERE expires_at <= ?", (time.time(),))
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO consumed_grants (nonce, expires_at) VALUES (?, ?)", (nonce, expires_at)
+        )
+        return cursor.rowcount == 1
+
+    async def consume(self, nonce: str, expires_at: float) -> bool:
+        try:
+            return await run_in_threadpool(self._consume, nonce, expires_at)
+        except sqlite3.Error as e:
+            raise LoginTokenStoreError(str(e)) from e
+
+
+class SignedLoginTokenStore(LoginTokenStore):
+    """
+    Stores nothing: the magic link itself carries the login token in a
+    grant that is encrypted and HMAC-signed with `secret` (a Fernet token),
+    together with the request_id and an expiry. `take` checks the grant
+    locally and records the request_id in `nonces` so the link works once.
+
+    Single use is only as wide as the nonce set: per worker for
+    `MemoryNonceSet`, per host for `SQLiteNonceSet`.
+    """
+
+    def __init__(self, secret: str, nonces):
+        # Derived, so the grant key differs from the key that signs the JWTs
+        key = hashlib.sha256(b"login-grant:" + secret.encode("utf-8")).digest()
+        self._fernet = Fernet(base64.urlsafe_b64encode(key))
+        self.nonces = nonces
+
+    async def put(self, request_id: str, token: str, ttl: int) -> str:
+        grant = {"n": request_id, "e": time.time() + ttl, "t": token}
+        sealed = self._fernet.encrypt(json.dumps(grant, separators=(",", ":")).encode("utf-8"))
+        return f"{self.link_path(request_id)}?grant={sealed.decode('ascii')}"
+
+    async def take(self, request_id: str, query_string: str) -> Optional[str]:
+        sealed = parse_qs(query_string).get("grant")
+        if not sealed:
+            return None
+        try:
+            grant = json.loads(self._fernet.decrypt(sealed[0].encode("ascii")))
+        except (InvalidToken, UnicodeEncodeError, ValueError):
+            return None
+
+        if grant.get("n") != request_id or grant.get("e", 0) <= time.time():
+            return None
+        if not await self.nonces.consume(request_id, grant["e"]):
+            return None
+        return grant["t"]
@@ -0,0 +1,75 @@
+"""
+A tiny in-process ASGI client, so benchmarks can drive the app without a
+server or an HTTP client library.
+"""
+import asyncio
+from typing import Dict, Iterable, Tuple
+from urllib.parse import urlencode
+
+
+async def call(
+    app,
+    method: str,
+    path: str,
+    headers: Iterable[Tuple[str, str]] = (),
+    body: bytes = b"",
+    cookies: Dict[str, str] = None,
+    form: Dict[str, object] = None,
+):
+    """Send one HTTP request through `app` and return (status, headers, body)."""
+    headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+    if cookies:
+        headers.append((b"cookie", "; ".join(f"{k}={v}" for k, v in cookies.items()).encode("latin-1")))
+    if form is not None:
+        body = urlencode(form, doseq=True).encode("utf-8")
+        headers.append((b"content-type", b"application/x-www-form-urlencoded"))
+    if body:
+        headers.append((b"content-length", str(len(body)).encode("latin-1")))
+
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "server": ("testserver", 80),
+        "client": ("127.0.0.1", 50000),
+        "root_path": "",
+        "path": path,
+        "raw_path": path.encode("utf-8"),
+        "query_string": query.encode("utf-8"),
+        "headers": [(b"host", b"testserver")] + headers,
+    }
+
+    sent = False
+    finished = asyncio.Event()
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        # Like a real client, only disconnect once the response is complete
+        await finished.wait()
+        return {"type": "http.disconnect"}
+
+    status = None
+    response_headers = []
+    chunks = []
+
+    async def send(message):
+        nonlocal status, response_headers
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            response_headers = [(k.decode("latin-1"), v.decode("latin-1")) for k, v in message.get("headers", [])]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body", False):
+                finished.set()
+
+    try:
+        await app(scope, receive, send)
+    finally:
+        finished.set()
+    return status, response_headers, b"".join(chunks)
@@ -0,0 +1,73 @@
+"""
+Micro-benchmark for `claim_required`.
+
+Measures the per-request cost of the decorator (request lookup, permission
+parsing and claim checks) on an authorized request, with the endpoint itself
+doing nothing.
+
+    python -m benchmarks.claims [iterations]
+"""
+import sys
+import time
+
+from starlette.requests import Request
+
+from decorators import claim_required
+
+PERMISSIONS = [f"{op}_{entity}" for op in ("read", "write", "delete") for entity in
+               ("foo", "bar", "baz", "qux", "admin", "billing", "reports", "users")]
+PATH_PARAMS = {f"e{i}": entity for i, entity in
+               enumerate(("foo", "bar", "baz", "qux", "admin", "billing", "reports", "users"))}
+
+
+async def _noop(request: Request, **kwargs):
+    return None
+
+
+def _make_request():
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "path": "/",
+        "headers": [],
+        "state": {"token_payload": {"sub": "bench", "permissions": ",".join(PERMISSIONS)}},
+    })
+
+
+def _run(endpoint, kwargs, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        # A fresh request each time, so permission parsing is included
+        coro = endpoint(request=_make_request(), **kwargs)
+        try:
+            coro.send(None)
+        except StopIteration:
+            pass
+    return (time.perf_counter() - start) / iterations
+
+
+def main(iterations: int = 100_000):
+    baseline = _run(_noop, PATH_PARAMS, iterations)
+    cases = {
+        "one plain claim": (claim_required("read_foo")(_noop), {}),
+        "one templated claim": (claim_required("read_{e0}")(_noop), {"e0": "foo"}),
+        "8 templated claims": (
+            claim_required(*[f"read_{{{name}}}" for name in PATH_PARAMS])(_noop),
+            PATH_PARAMS,
+        ),
+        "24 templated claims": (
+            claim_required(*[f"{op}_{{{name}}}" for op in ("read", "write", "delete")
+                             for name in PATH_PARAMS])(_noop),
+            PATH_PARAMS,
+        ),
+    }
+
+    print(f"{'case':<24}{'ns/request':>12}")
+    print(f"{'undecorated endpoint':<24}{baseline * 1e9:>12.0f}")
+    for name, (endpoint, kwargs) in cases.items():
+        elapsed = _run(endpoint, kwargs, iterations)
+        print(f"{name:<24}{(elapsed - baseline) * 1e9:>12.0f}")
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:2]))
@@ -0,0 +1,46 @@
+"""
+Compare two result files written by `python -m benchmarks.suite --json`.
+
+    python -m benchmarks.compare before.json after.json
+
+Changes are shown relative to the first file; for us/op and latencies lower
+is better, for rps higher is better.
+"""
+import json
+import sys
+
+
+def _delta(before, after):
+    if not before:
+        return "     n/a"
+    return f"{(after - before) / before * 100:>+7.1f}%"
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.exit(__doc__.strip().splitlines()[2].strip())
+
+    with open(sys.argv[1]) as f:
+        before = json.load(f)
+    with open(sys.argv[2]) as f:
+        after = json.load(f)
+
+    print(f"{before['meta'].get('commit')} -> {after['meta'].get('commit')}\n")
+
+    print(f"{'micro-benchmark':<32}{'before':>10}{'after':>10}{'change':>9}")
+    for name, result in after["micro"].items():
+        old = before["micro"].get(name, {}).get("us_per_op")
+        new = result["us_per_op"]
+        print(f"{name:<32}{old if old is not None else float('nan'):>10.1f}{new:>10.1f}{_delta(old, new):>9}")
+
+    print()
+    print(f"{'scenario':<20}{'metric':<8}{'before':>10}{'after':>10}{'change':>9}")
+    for name, result in after["load"].items():
+        for metric in ("rps", "p50_ms", "p99_ms"):
+            old = before["load"].get(name, {}).get(metric)
+            new = result[metric]
+            print(f"{name:<20}{metric:<8}{old if old is not None else float('nan'):>10.1f}{new:>10.1f}{_delta(old, new):>9}")
+
+
+if __name__ == "__main__":
+    main()
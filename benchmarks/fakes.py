@@ -0,0 +1,143 @@
+"""
+Local stand-ins for the remote services the app talks to.
+
+`FakeServices` is a threaded HTTP server that speaks just enough of the S3
+object API (PUT/GET on /<bucket>/<key>) and the Resend email API
+(POST /emails, POST /emails/batch) for the login flow, with a configurable
+artificial latency. Point the app at it with AWS_ENDPOINT_URL / S3_BASE and
+RESEND_API_URL before importing `main`.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _reply(self, status, body=b"", content_type="application/octet-stream"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _json(self, status, data):
+        self._reply(status, json.dumps(data).encode("utf-8"), "application/json")
+
+    def do_PUT(self):
+        body = self._read_body()
+        time.sleep(self.server.latency)
+        self.server.objects[urlparse(self.path).path] = body
+        self._reply(200)
+
+    def do_DELETE(self):
+        time.sleep(self.server.latency)
+        self.server.objects.pop(urlparse(self.path).path, None)
+        self._reply(204)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        body = self.server.objects.get(url.path)
+        if body is None or "Signature=" not in url.query:
+            self._reply(403)
+        else:
+            self._reply(200, body, "application/jwt")
+
+    def do_POST(self):
+        body = json.loads(self._read_body() or b"null")
+        time.sleep(self.server.latency)
+        path = urlparse(self.path).path
+        if path == "/emails/batch":
+            self.server.emails.extend(body)
+            self._json(200, {"data": [{"id": str(uuid.uuid4())} for _ in body]})
+        elif path == "/emails":
+            self.server.emails.append(body)
+            self._json(200, {"id": str(uuid.uuid4())})
+        else:
+            self._reply(404)
+
+
+class FakeServices:
+    def __init__(self, latency: float = 0.05, host: str = "127.0.0.1", port: int = 0):
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.objects = {}
+        self.server.emails = []
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def objects(self):
+        return self.server.objects
+
+    @property
+    def emails(self):
+        return self.server.emails
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def configure_env(services: FakeServices, bucket: str = "bench-bucket"):
+    """Point the app's S3 and Resend settings at `services`. Call before importing `main`."""
+    os.environ.update({
+        "AWS_ENDPOINT_URL": services.url,
+        "AWS_S3_BUCKET_NAME": bucket,
+        "S3_BASE": f"{services.url}/{bucket}",
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "RESEND_API_URL": services.url,
+        "RESEND_API_KEY": "re_bench",
+        "RAILWAY_PUBLIC_DOMAIN": "http://testserver",
+    })
+    # Every benchmark client shares one address, so the per-IP limits would only measure 429s
+    for name in ("LOGIN_RATE_PER_IP", "LOGIN_RATE_PER_EMAIL", "BULK_LOGIN_RATE_PER_IP", "IDP_TOKEN_RATE_PER_IP"):
+        os.environ.setdefault(name, "0")
+    # main mounts ./static, which only exists in deployed checkouts
+    os.makedirs("static", exist_ok=True)
+
+
+class FakeMailTransport:
+    """
+    In-memory stand-in for `Services.email.ResendTransport`.
+
+    Each batch takes `latency` seconds, and the first `failures` batches
+    raise, to exercise the queue's retries.
+    """
+
+    def __init__(self, latency: float = 0.05, failures: int = 0):
+        self.latency = latency
+        self.failures = failures
+        self.batches = []
+
+    async def send_batch(self, messages):
+        await asyncio.sleep(self.latency)
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("fake transport failure")
+        self.batches.append(list(messages))
@@ -0,0 +1,53 @@
+"""
+Cold-start cost of importing the mock IdP.
+
+Times `import idp_router` (after its third-party dependencies) in fresh interpreters, once generating a new signing
+key every start (what happened before keys were persisted) and once loading
+the persisted key file.
+
+    python -m benchmarks.idp_startup [--runs 10]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# Dependencies are imported first so the timing isolates idp_router's own setup
+SNIPPET = (
+    "import time, fastapi, authlib.jose, cryptography.hazmat.primitives.asymmetric.rsa;"
+    "t = time.perf_counter(); import idp_router; idp_router.KEYS.load(); print(time.perf_counter() - t)"
+)
+
+
+def _import_time(env) -> float:
+    out = subprocess.run([sys.executable, "-c", SNIPPET], env=env, check=True,
+                         capture_output=True, text=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, IDP_KEYS_FILE=os.path.join(tmp, "idp_keys.json"))
+        env.pop("IDP_SIGNING_KEY", None)
+
+        generated = []
+        for _ in range(args.runs):
+            if os.path.exists(env["IDP_KEYS_FILE"]):
+                os.remove(env["IDP_KEYS_FILE"])
+            generated.append(_import_time(env))
+
+        persisted = [_import_time(env) for _ in range(args.runs)]
+
+    print(f"{'import idp_router':<24}{'median ms':>10}{'max ms':>10}")
+    for name, samples in (("generate key", generated), ("load persisted key", persisted)):
+        print(f"{name:<24}{statistics.median(samples) * 1000:>10.1f}{max(samples) * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
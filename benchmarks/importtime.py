@@ -0,0 +1,97 @@
+"""
+Import-time report for `import main`, as a cold-start regression check.
+
+Runs `python -X importtime -c "import main"` in fresh interpreters and
+prints the slowest top-level packages by cumulative time. With `--check`
+it exits non-zero if the median import takes longer than the budget in
+benchmarks/importtime.json, or if any module listed there as deferred
+(boto3, Resend, Authlib, ...) is imported before the first request.
+
+    python -m benchmarks.importtime [--runs 5] [--check] [--update]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BASELINE = os.path.join(os.path.dirname(__file__), "importtime.json")
+
+SNIPPET = "import time; t = time.perf_counter(); import main; print(time.perf_counter() - t)"
+
+
+def _run(env):
+    """
+    One cold import. Returns the seconds it took and {top-level package:
+    us spent importing its own modules}, for every package imported.
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", SNIPPET], env=env, check=True,
+                          capture_output=True, text=True)
+    packages = {}
+    for line in proc.stderr.splitlines():
+        # "import time:       self [us] |  cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        own, _, name = line[len("import time:"):].split("|")
+        # Self time, so a package isn't charged for the dependencies it pulls in
+        top = name.strip().split(".")[0]
+        packages[top] = packages.get(top, 0) + int(own)
+    return float(proc.stdout.strip().splitlines()[-1]), packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="packages to list")
+    parser.add_argument("--check", action="store_true", help="fail if over budget or a deferred module is imported")
+    parser.add_argument("--update", action="store_true", help="record this run's packages in the baseline file")
+    args = parser.parse_args()
+
+    with open(BASELINE) as f:
+        baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Throwaway databases and key file, so the check never touches a developer's own
+        env = dict(
+            os.environ,
+            IDP_KEYS_FILE=os.path.join(tmp, "idp_keys.json"),
+            LOGIN_TOKEN_DB=os.path.join(tmp, "login_tokens.db"),
+            REVOCATION_DB=os.path.join(tmp, "revocations.db"),
+            RATE_LIMIT_DB=os.path.join(tmp, "ratelimit.db"),
+        )
+        # main mounts ./static, which only exists in deployed checkouts
+        os.makedirs("static", exist_ok=True)
+        runs = [_run(env) for _ in range(args.runs)]
+
+    total = statistics.median(seconds for seconds, _ in runs)
+    names = set().union(*(run[1] for run in runs))
+    packages = {name: statistics.median(run[1].get(name, 0) for run in runs) for name in names}
+
+    print(f"{'package':<32}{'ms':>14}")
+    for name, us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"{name:<32}{us / 1000:>14.1f}")
+    print(f"\n{'import main':<32}{total * 1000:>14.1f}  (median of {args.runs}, budget {baseline['budget_ms']} ms)")
+
+    if args.update:
+        baseline["packages_ms"] = {
+            name: round(us / 1000, 1) for name, us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]
+        }
+        with open(BASELINE, "w") as f:
+            json.dump(baseline, f, indent=2)
+            f.write("\n")
+        print(f"wrote {BASELINE}", file=sys.stderr)
+
+    if args.check:
+        problems = [f"{name} is imported at startup" for name in baseline["deferred"] if name in names]
+        if total * 1000 > baseline["budget_ms"]:
+            problems.append(f"import main took {total * 1000:.0f} ms, budget is {baseline['budget_ms']} ms")
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
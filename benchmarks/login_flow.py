@@ -0,0 +1,89 @@
+"""
+End-to-end magic-link login latency per login-token store.
+
+Each iteration POSTs /request-login, pulls the link out of the email the
+Resend stand-in received, and follows it to /jwt/<id>.jwt. Every store runs
+in its own process because `main` picks the store at import time.
+
+    python -m benchmarks.login_flow [--store s3|sqlite|memory|signed] [--logins 200] [--latency 0.05]
+"""
+import argparse
+import asyncio
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.asgi import call
+from benchmarks.fakes import FakeServices, configure_env
+from benchmarks.stats import summarize
+
+STORES = ("s3", "sqlite", "memory", "signed")
+LINK = re.compile(r'href="http://testserver(/jwt/[^"]+)"')
+
+
+async def _run(app, services, logins):
+    from Services.email import mail_queue
+
+    request_samples, link_samples = [], []
+    start = time.perf_counter()
+    for i in range(logins):
+        t0 = time.perf_counter()
+        status, _, _ = await call(app, "POST", "/request-login", form={
+            "email": f"bench{i}@example.com",
+            "expire_in": 60,
+            "permissions": ["read_foo"],
+        })
+        request_samples.append(time.perf_counter() - t0)
+        assert status == 200, status
+
+        await mail_queue._queue.join()
+        link = LINK.search(services.emails[-1]["html"]).group(1)
+
+        t0 = time.perf_counter()
+        status, _, _ = await call(app, "GET", link)
+        link_samples.append(time.perf_counter() - t0)
+        assert status == 302, status
+
+    elapsed = time.perf_counter() - start
+    await mail_queue.stop()
+    return summarize(request_samples, elapsed), summarize(link_samples, elapsed)
+
+
+def _run_store(store, args):
+    with FakeServices(latency=args.latency) as services, tempfile.TemporaryDirectory() as tmp:
+        configure_env(services)
+        os.environ["LOGIN_TOKEN_STORE"] = store
+        os.environ["LOGIN_TOKEN_DB"] = os.path.join(tmp, "login_tokens.db")
+        import main as app_module
+        request_stats, link_stats = asyncio.run(_run(app_module.app, services, args.logins))
+
+    for name, stats in (("POST /request-login", request_stats), ("GET /jwt/<id>.jwt", link_stats)):
+        print(f"{store:<8}{name:<22}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--store", choices=STORES)
+    parser.add_argument("--logins", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05, help="stand-in S3/Resend latency in seconds")
+    args = parser.parse_args()
+
+    if args.store:
+        _run_store(args.store, args)
+        return
+
+    print(f"{'store':<8}{'request':<22}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    sys.stdout.flush()
+    for store in STORES:
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.login_flow", "--store", store,
+             "--logins", str(args.logins), "--latency", str(args.latency)],
+            check=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+p99 latency of authenticated page views while logins are in flight.
+
+Runs the app in-process against the local S3/Resend stand-in and measures
+GET /logged-in, first on its own and then while `--logins` clients keep
+POSTing /request-login. If a login blocks the event loop the second p99
+jumps by roughly the storage latency.
+
+    python -m benchmarks.login_latency [--latency 0.05] [--logins 8] [--duration 5] [--rate 200]
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.asgi import call
+from benchmarks.fakes import FakeServices, configure_env
+from benchmarks.stats import summarize
+
+
+async def _page_views(app, cookies, duration, rate):
+    """
+    Open-loop page views: requests are scheduled `rate` times a second and
+    latency is measured from the scheduled time, so time spent waiting for a
+    blocked event loop is counted.
+    """
+    samples = []
+
+    async def view(scheduled):
+        status, _, _ = await call(app, "GET", "/logged-in", cookies=cookies)
+        samples.append(time.perf_counter() - scheduled)
+        assert status == 200, status
+
+    tasks = []
+    start = time.perf_counter()
+    for i in range(int(duration * rate)):
+        scheduled = start + i / rate
+        await asyncio.sleep(max(0, scheduled - time.perf_counter()))
+        tasks.append(asyncio.create_task(view(scheduled)))
+    await asyncio.gather(*tasks)
+    return samples
+
+
+async def _logins(app, duration):
+    count = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        status, _, _ = await call(app, "POST", "/request-login", form={
+            "email": f"bench{count}@example.com",
+            "expire_in": 60,
+            "permissions": ["read_foo"],
+        })
+        assert status == 200, status
+        count += 1
+    return count
+
+
+async def _run(app, token, logins, duration, rate):
+    cookies = {"auth_token": token}
+    start = time.perf_counter()
+    idle = await _page_views(app, cookies, duration, rate)
+    idle_stats = summarize(idle, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        _page_views(app, cookies, duration, rate),
+        *[_logins(app, duration) for _ in range(logins)],
+    )
+    elapsed = time.perf_counter() - start
+    busy_stats = summarize(results[0], elapsed)
+    busy_stats["logins"] = sum(results[1:])
+
+    from Services.email import mail_queue
+    await mail_queue.stop()
+    return idle_stats, busy_stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--latency", type=float, default=0.05, help="stand-in S3/Resend latency in seconds")
+    parser.add_argument("--logins", type=int, default=8, help="concurrent login clients")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per phase")
+    parser.add_argument("--rate", type=float, default=200, help="page views per second")
+    args = parser.parse_args()
+
+    with FakeServices(latency=args.latency) as services:
+        configure_env(services)
+        import main as app_module
+        from logins import ALGORITHM
+        from datetime import datetime, timedelta
+        token = app_module.jwt.encode({
+            "user_id": "bench",
+            "username": "bench@example.com",
+            "exp": datetime.now() + timedelta(hours=1),
+            "permissions": "read_loggedIn",
+        }, app_module.SECRET_KEY, algorithm=ALGORITHM)
+
+        idle, busy = asyncio.run(_run(app_module.app, token, args.logins, args.duration, args.rate))
+        emails = len(services.emails)
+
+    print(f"{'GET /logged-in':<24}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in (("idle", idle), (f"{args.logins} logins in flight", busy)):
+        print(f"{name:<24}{stats['rps']:>10.0f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}")
+    print(f"logins completed: {busy['logins']}, emails delivered: {emails}")
+
+
+if __name__ == "__main__":
+    main()
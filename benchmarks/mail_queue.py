@@ -0,0 +1,52 @@
+"""
+Throughput of the outbound mail queue against a fake transport.
+
+Submits `--messages` emails as fast as possible and reports how long
+submitting took (what a request handler pays) and how long delivery took.
+
+    python -m benchmarks.mail_queue [--messages 2000] [--latency 0.05] [--batch-size 100]
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.fakes import FakeMailTransport
+from Services.email import MailQueue, build_mail
+
+
+async def _run(args):
+    transport = FakeMailTransport(latency=args.latency, failures=args.failures)
+    queue = MailQueue(
+        transport,
+        max_size=args.messages,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        retry_backoff=0.01,
+    )
+
+    start = time.perf_counter()
+    for i in range(args.messages):
+        queue.submit(build_mail([f"bench{i}@example.com"], "Bench", "<p>bench</p>"))
+    submitted = time.perf_counter() - start
+    await queue.stop(timeout=600)
+    delivered = time.perf_counter() - start
+    return submitted, delivered, queue.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake provider latency per call")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--failures", type=int, default=0, help="number of batches that fail once")
+    args = parser.parse_args()
+
+    submitted, delivered, stats = asyncio.run(_run(args))
+    print(f"submit:  {submitted / args.messages * 1e6:.1f} us/message")
+    print(f"deliver: {args.messages / delivered:.0f} messages/s ({delivered:.2f}s total)")
+    print("stats:  ", stats)
+
+
+if __name__ == "__main__":
+    main()
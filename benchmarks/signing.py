@@ -0,0 +1,65 @@
+"""
+ID-token signing throughput of the mock IdP, per algorithm, on one core.
+
+Signs the same payload `idp_router.token` builds, with a pre-loaded key
+object (what the IdP does now) and, for comparison, by handing Authlib the
+PEM so it is re-parsed on every call. Every token is checked against the
+published JWKS once.
+
+    python -m benchmarks.signing [--seconds 2] [--algs RS256,PS256,ES256,EdDSA]
+"""
+import argparse
+import time
+
+from authlib.jose import JsonWebKey, jwt
+
+from idp_keys import KEY_TYPES, SigningKey, generate_private_key
+from idp_router import PERSONAS
+
+
+def _payload():
+    now = int(time.time())
+    payload = {
+        "iss": "https://jwt.knollfear.com/idp/persona/oidc",
+        "aud": "my-keycloak-client",
+        "iat": now,
+        "exp": now + 3600,
+    }
+    payload.update(PERSONAS["admin"])
+    return payload
+
+
+def _rate(sign, seconds):
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(20):
+            sign()
+        count += 20
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--seconds", type=float, default=2)
+    parser.add_argument("--algs", default=",".join(KEY_TYPES))
+    args = parser.parse_args()
+
+    payload = _payload()
+    print(f"{'alg':<8}{'tokens/s (key object)':>24}{'tokens/s (PEM)':>18}")
+    for alg in args.algs.split(","):
+        key = SigningKey(generate_private_key(alg), alg)
+        header = {"alg": alg, "kid": key.kid}
+
+        token = jwt.encode(header, payload, key.signer)
+        keyset = JsonWebKey.import_key_set({"keys": [key.public_jwk]})
+        assert jwt.decode(token, keyset)["sub"] == payload["sub"]
+
+        cached = _rate(lambda: jwt.encode(header, payload, key.signer), args.seconds)
+        from_pem = _rate(lambda: jwt.encode(header, payload, key.pem), args.seconds)
+        print(f"{alg:<8}{cached:>24.0f}{from_pem:>18.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""
+The full offline benchmark suite.
+
+Micro-benchmarks (token decode, claim check, ID token signing, template
+render) followed by in-process ASGI load scenarios (static assets,
+authenticated page views, login bursts and the OIDC authorize -> callback
+-> token flow). S3 and Resend are replaced by the local stand-in from
+`benchmarks.fakes`, so nothing leaves the machine.
+
+    python -m benchmarks.suite [--duration 3] [--concurrency 16] [--json results.json]
+    python -m benchmarks.compare before.json after.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks.asgi import call
+from benchmarks.fakes import FakeServices, configure_env
+from benchmarks.stats import summarize
+
+STATIC_ASSET = "_bench.css"
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _per_op(fn, seconds):
+    """Average seconds per call of `fn`, run for roughly `seconds`."""
+    fn()
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while time.perf_counter() < deadline:
+        for _ in range(50):
+            fn()
+        count += 50
+    return (time.perf_counter() - start) / count
+
+
+# --- Micro-benchmarks ---
+
+def micro(app_module, seconds):
+    import jwt
+    from benchmarks import claims
+    from decorators import claim_required, templates
+    from idp_router import KEYS, signing_alg
+    from idp_tokens import id_token_payload, sign_id_token
+    from logins import ALGORITHM
+    from middleware import JWTAuthMiddleware
+    from token_cache import TokenCache
+
+    token = _app_token(app_module)
+    uncached = JWTAuthMiddleware(None, cache=None)
+    cached = JWTAuthMiddleware(None, cache=TokenCache())
+
+    key = KEYS.signing_key(signing_alg("persona"))
+    payload = id_token_payload("persona", {"sub": "bench", "roles": ["viewer"]})
+
+    loggedin = templates.get_template("loggedIn.html")
+    signup = templates.get_template("signup.html")
+    request = claims._make_request()
+
+    with_claim = claim_required("read_foo")(claims._noop)
+
+    def claim_check():
+        coro = with_claim(request=claims._make_request())
+        try:
+            coro.send(None)
+        except StopIteration:
+            pass
+
+    results = {
+        "jwt_decode_hs256": _per_op(lambda: jwt.decode(token, app_module.SECRET_KEY, algorithms=[ALGORITHM]), seconds),
+        "middleware_decode_uncached": _per_op(lambda: uncached.decode(token), seconds),
+        "middleware_decode_cached": _per_op(lambda: cached.decode(token), seconds),
+        "claim_check": _per_op(claim_check, seconds),
+        f"id_token_sign_{key.alg.lower()}": _per_op(lambda: sign_id_token(key, payload), seconds),
+        "render_loggedIn": _per_op(lambda: loggedin.render({"request": request}), seconds),
+        "render_signup": _per_op(lambda: signup.render({"request": request, "message": None, "available_permissions": []}), seconds),
+    }
+    return {name: {"us_per_op": value * 1e6} for name, value in results.items()}
+
+
+# --- Load scenarios ---
+
+def _app_token(app_module, permissions="read_loggedIn,read_foo"):
+    from logins import ALGORITHM
+
+    return app_module.jwt.encode({
+        "user_id": "bench",
+        "username": "bench@example.com",
+        "exp": datetime.now(tz=timezone.utc) + timedelta(hours=1),
+        "permissions": permissions,
+    }, app_module.SECRET_KEY, algorithm=ALGORITHM)
+
+
+async def _closed_loop(op, concurrency, duration):
+    """`concurrency` clients each running `op` back to back for `duration` seconds."""
+    samples = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+
+    async def client(worker):
+        nonlocal errors
+        i = 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                ok = await op(worker, i)
+            except Exception:
+                ok = False
+            samples.append(time.perf_counter() - start)
+            errors += not ok
+            i += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(worker) for worker in range(concurrency)])
+    result = summarize(samples, time.perf_counter() - start)
+    result["errors"] = errors
+    return result
+
+
+async def load(app_module, concurrency, duration):
+    app = app_module.app
+    cookies = {"auth_token": _app_token(app_module)}
+
+    async def static_asset(worker, i):
+        status, _, _ = await call(app, "GET", f"/static/{STATIC_ASSET}")
+        return status == 200
+
+    async def page_view(worker, i):
+        status, _, _ = await call(app, "GET", "/logged-in", cookies=cookies)
+        return status == 200
+
+    async def claim_page(worker, i):
+        status, _, _ = await call(app, "GET", "/logged-in/claim/read/foo", cookies=cookies)
+        return status == 200
+
+    async def login(worker, i):
+        status, _, _ = await call(app, "POST", "/request-login", form={
+            "email": f"bench-{worker}-{i}@example.com",
+            "expire_in": 60,
+            "permissions": ["read_foo"],
+        })
+        return status == 200
+
+    async def oidc_flow(worker, i):
+        redirect_uri = "http://testserver/idp/persona/oidc/callback-preview"
+        status, _, _ = await call(app, "GET", f"/idp/persona/oidc/authorize?redirect_uri={redirect_uri}&state=s&nonce=n")
+        if status != 200:
+            return False
+        status, headers, _ = await call(app, "POST", "/idp/persona/oidc/login-callback", form={
+            "persona_choice": "admin", "redirect_uri": redirect_uri, "state": "s", "nonce": "n",
+        })
+        if status != 303:
+            return False
+        code = parse_qs(urlparse(dict(headers)["location"]).query)["code"][0]
+        status, _, _ = await call(app, "POST", "/idp/persona/oidc/token", form={"code": code})
+        return status == 200
+
+    scenarios = {
+        "static_asset": static_asset,
+        "page_view": page_view,
+        "claim_page": claim_page,
+        "login_burst": login,
+        "oidc_flow": oidc_flow,
+    }
+    results = {}
+    for name, op in scenarios.items():
+        results[name] = await _closed_loop(op, concurrency, duration)
+
+    from Services.email import mail_queue
+    await mail_queue.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--duration", type=float, default=3, help="seconds per load scenario")
+    parser.add_argument("--micro-seconds", type=float, default=1, help="seconds per micro-benchmark")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.02, help="stand-in S3/Resend latency in seconds")
+    parser.add_argument("--store", default="s3", help="LOGIN_TOKEN_STORE to use for the login scenario")
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    with FakeServices(latency=args.latency) as services:
+        configure_env(services)
+        os.environ["LOGIN_TOKEN_STORE"] = args.store
+        asset = os.path.join("static", STATIC_ASSET)
+        with open(asset, "w") as f:
+            f.write("body { color: #333; }\n" * 200)
+
+        try:
+            import main as app_module
+            micro_results = micro(app_module, args.micro_seconds)
+            load_results = asyncio.run(load(app_module, args.concurrency, args.duration))
+        finally:
+            os.remove(asset)
+
+    results = {
+        "meta": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "timestamp": datetime.now(tz=timezone.utc).isoformat(),
+            "args": vars(args),
+        },
+        "micro": micro_results,
+        "load": load_results,
+    }
+
+    print(f"{'micro-benchmark':<32}{'us/op':>10}")
+    for name, value in micro_results.items():
+        print(f"{name:<32}{value['us_per_op']:>10.1f}")
+    print()
+    print(f"{'scenario':<32}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, value in load_results.items():
+        print(f"{name:<32}{value['rps']:>10.0f}{value['p50_ms']:>10.2f}{value['p95_ms']:>10.2f}"
+              f"{value['p99_ms']:>10.2f}{value['errors']:>8}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nwrote {args.json}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
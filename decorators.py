@@ -1,19 +1,79 @@
+import inspect
 from functools import wraps
-from typing import Optional
+from string import Formatter
+from typing import Callable, Dict, Optional
 from fastapi import Request
-from fastapi.templating import Jinja2Templates
 
-templates = Jinja2Templates(directory="templates")
+from metrics import Counter
+from permissions import REGISTRY, PermissionSet, declare_claims, parse_permissions
+from profiling import phase
+from templating import static_page, templates
 
+# Labelled with the claim template, not the rendered claim, so path params can't grow the label set
+AUTH_DENIALS = Counter("auth_denials_total", "Requests refused by claim_required", ("status", "claim"))
 
-def claim_required(required: Optional[str] = None):
+
+def get_permissions(request: Request) -> PermissionSet:
+    """
+    The permissions granted by the request's token, parsed once per request
+    and kept on `request.state.permissions`.
+    """
+    permissions = getattr(request.state, "permissions", None)
+    if permissions is None:
+        permissions = parse_permissions(getattr(request.state, "token_payload", None))
+        request.state.permissions = permissions
+    return permissions
+
+
+def _is_static(template: str) -> bool:
+    return all(field is None for _, field, _, _ in Formatter().parse(template))
+
+
+def _compile_claim(template: str) -> Callable[[Dict], str]:
+    """
+    Pre-parse a claim template such as "{op}_{entity}" into a function of the
+    endpoint's kwargs, so the format string isn't re-parsed on every request.
+    """
+    segments = list(Formatter().parse(template))
+    if all(field is None for _, field, _, _ in segments):
+        return lambda kwargs: template
+
+    if any(spec or conversion for _, _, spec, conversion in segments):
+        # Anything fancier than plain substitution goes through str.format
+        return lambda kwargs: template.format(**kwargs)
+
+    def render(kwargs):
+        parts = []
+        for literal, field, _, _ in segments:
+            parts.append(literal)
+            if field is not None:
+                parts.append(str(kwargs[field]))
+        return "".join(parts)
+
+    return render
+
+
+def _find_request_param(endpoint) -> Optional[str]:
+    for name, param in inspect.signature(endpoint).parameters.items():
+        if param.annotation is Request or name == "request":
+            return name
+    return None
+
+
+def claim_required(*required: Optional[str]):
     """
     Decorator for FastAPI endpoints.
 
-    - If `required` is None: just requires a valid token (authenticated user).
+    - With no arguments (or None): just requires a valid token (authenticated user).
     - If `required` is a plain string, e.g. "read_loggedIn", require that claim.
     - If `required` is a format string with {…}, e.g. "{op}_{entity}",
       it will be formatted with the endpoint's kwargs (e.g. op, entity).
+    - Several claims may be passed; all of them are required.
+
+    Claim templates are compiled once, when the route is decorated, and the
+    token's permissions are parsed once per request into a `PermissionSet`.
+    Plain claims known to the permission registry are checked with a single
+    bitmask.
 
     Examples:
 
@@ -25,56 +85,64 @@ def claim_required(required: Optional[str] = None):
         @claim_required("{op}_{entity}")
         async def claim_page(request: Request, op: str, entity: str): ...
     """
+    claims = [(claim, _compile_claim(claim)) for claim in required if claim is not None]
+    route_claims = ",".join(claim for claim, _ in claims)
+
+    static = [claim for claim, _ in claims if _is_static(claim)]
+    declare_claims(static)
+    static_mask = REGISTRY.mask(static)
+    static_others = [claim for claim in static if claim not in REGISTRY.bits]
+    templated = [(claim, render) for claim, render in claims if not _is_static(claim)]
 
     def decorator(endpoint):
+        request_param = _find_request_param(endpoint)
+        if request_param is None:
+            raise RuntimeError(
+                "Endpoint decorated with @claim_required must include a 'request: Request' parameter."
+            )
+
         @wraps(endpoint)
         async def wrapper(*args, **kwargs):
-            # Find the Request object
-            request: Optional[Request] = kwargs.get("request")
+            # FastAPI always passes endpoint parameters by keyword
+            request: Optional[Request] = kwargs.get(request_param)
             if request is None:
                 for arg in args:
                     if isinstance(arg, Request):
                         request = arg
                         break
 
-            if request is None:
-                raise RuntimeError(
-                    "Endpoint decorated with @claim_required must include a 'request: Request' parameter."
-                )
-
             payload = getattr(request.state, "token_payload", None)
-            permissions = []
-            if isinstance(payload, dict):
-                permissions = payload.get("permissions", []) or []
-
-
-            if not payload or payload == []:
-                return templates.TemplateResponse(
-                    "unauthorized.html",
-                    {
-                        "request": request,
-                    },
-                    status_code=401,
-                )
-
-            # Compute the actual required claim
-            if "{" in required and "}" in required:
-                # Template like "{op}_{entity}"
-                try:
-                    required_claim = required.format(**kwargs)
-                except KeyError as e:
-                    raise RuntimeError(
-                        f"Missing path parameter {e!s} needed for claim template '{required}'"
-                    )
-            else:
-                required_claim = required
-
-            if required_claim not in permissions:
+            if not payload:
+                AUTH_DENIALS.inc("401", route_claims)
+                # Same bytes for every anonymous request, so it comes from the render cache
+                return static_page("unauthorized.html", status_code=401)
+
+            with phase("authz"):
+                permissions = get_permissions(request)
+                missing = None
+                if not permissions.has_all(static_mask, static_others):
+                    claim = next(claim for claim in static if claim not in permissions)
+                    missing = claim, claim
+                else:
+                    for template, render in templated:
+                        try:
+                            required_claim = render(kwargs)
+                        except KeyError as e:
+                            raise RuntimeError(
+                                f"Missing path parameter {e!s} needed for claim template '{template}'"
+                            )
+                        if required_claim not in permissions:
+                            missing = template, required_claim
+                            break
+
+            if missing is not None:
+                template, required_claim = missing
+                AUTH_DENIALS.inc("403", template)
                 context = {
                     "request": request,
                     "required_claim": required_claim,
-                    "permissions": permissions,
-                    "email": (payload or {}).get("sub"),
+                    "permissions": permissions.readable(),
+                    "email": payload.get("sub"),
                 }
                 return templates.TemplateResponse(
                     "forbidden.html",
@@ -87,4 +155,4 @@ def claim_required(required: Optional[str] = None):
 
         return wrapper
 
-    return decorator
\ No newline at end of file
+    return decorator
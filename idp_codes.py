@@ -0,0 +1,199 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from sqlite_local import LocalConnection
+
+
+class AuthCodeStore:
+    """
+    Short-lived, single-use authorization codes for the mock IdP.
+
+    Codes expire after `ttl` seconds, the oldest codes are evicted once more
+    than `max_size` are outstanding, and a background task (started on first
+    use) sweeps expired codes every `sweep_interval` seconds.
+    """
+
+    def __init__(self, ttl: float = 60, max_size: int = 10000, sweep_interval: float = 30):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+
+        self.issued = 0
+        self.redeemed = 0
+        self.invalid = 0
+        self.expired = 0
+        self.evicted = 0
+
+        self._sweeper: Optional[asyncio.Task] = None
+
+    async def put(self, code: str, claims: Dict[str, Any]) -> None:
+        self._start_sweeper()
+        self.evicted += await self._put(code, claims, time.time() + self.ttl)
+        self.issued += 1
+
+    async def take(self, code: str) -> Optional[Dict[str, Any]]:
+        """Redeem a code. Returns None if it is unknown, already used or expired."""
+        entry = await self._take(code)
+        if entry is None:
+            self.invalid += 1
+            return None
+
+        expires_at, claims = entry
+        if expires_at <= time.time():
+            self.expired += 1
+            self.invalid += 1
+            return None
+
+        self.redeemed += 1
+        return claims
+
+    async def sweep(self) -> int:
+        removed = await self._sweep(time.time())
+        self.expired += removed
+        return removed
+
+    def _start_sweeper(self) -> None:
+        if self._sweeper is None and self.sweep_interval > 0:
+            self._sweeper = asyncio.create_task(self._sweep_forever())
+
+    async def _sweep_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception as e:
+                print("Error sweeping authorization codes:", e)
+
+    async def stop(self) -> None:
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            await asyncio.gather(self._sweeper, return_exceptions=True)
+            self._sweeper = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": self.size(),
+            "max_size": self.max_size,
+            "issued": self.issued,
+            "redeemed": self.redeemed,
+            "invalid": self.invalid,
+            "expired": self.expired,
+            "evicted": self.evicted,
+        }
+
+    # Backend hooks
+
+    async def _put(self, code: str, claims: Dict[str, Any], expires_at: float) -> int:
+        """Store a code, returning how many codes had to be evicted to make room."""
+        raise NotImplementedError
+
+    async def _take(self, code: str) -> Optional[tuple]:
+        raise NotImplementedError
+
+    async def _sweep(self, now: float) -> int:
+        raise NotImplementedError
+
+    def size(self) -> int:
+        raise NotImplementedError
+
+
+class MemoryAuthCodeStore(AuthCodeStore):
+    """Process-local store; a code is only redeemable on the worker that issued it."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Insertion order == expiry order, since every code gets the same ttl
+        self._codes: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def _put(self, code, claims, expires_at):
+        self._codes[code] = (expires_at, claims)
+        evicted = 0
+        while len(self._codes) > self.max_size:
+            self._codes.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    async def _take(self, code):
+        return self._codes.pop(code, None)
+
+    async def _sweep(self, now):
+        removed = 0
+        while self._codes:
+            code, (expires_at, _) = next(iter(self._codes.items()))
+            if expires_at > now:
+                break
+            del self._codes[code]
+            removed += 1
+        return removed
+
+    def size(self):
+        return len(self._codes)
+
+
+class SQLiteAuthCodeStore(AuthCodeStore):
+    """
+    Store backed by a WAL-mode SQLite file, so a code issued by one Hypercorn
+    worker can be redeemed on any other worker on the same host.
+    """
+
+    def __init__(self, path: str, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = path
+        self._connect = LocalConnection(path)
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS auth_codes ("
+            " code TEXT PRIMARY KEY,"
+            " claims TEXT NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+        self._connect().execute("CREATE INDEX IF NOT EXISTS auth_codes_expiry ON auth_codes (expires_at)")
+
+    def _put_sync(self, code, claims, expires_at):
+        db = self._connect()
+        db.execute(
+            "INSERT OR REPLACE INTO auth_codes (code, claims, expires_at) VALUES (?, ?, ?)",
+            (code, json.dumps(claims), expires_at),
+        )
+        overflow = db.execute("SELECT COUNT(*) FROM auth_codes").fetchone()[0] - self.max_size
+        if overflow <= 0:
+            return 0
+        return db.execute(
+            "DELETE FROM auth_codes WHERE code IN"
+            " (SELECT code FROM auth_codes ORDER BY expires_at LIMIT ?)",
+            (overflow,),
+        ).rowcount
+
+    def _take_sync(self, code):
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT expires_at, claims FROM auth_codes WHERE code = ?", (code,)).fetchone()
+            if row is not None:
+                db.execute("DELETE FROM auth_codes WHERE code = ?", (code,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _sweep_sync(self, now):
+        return self._connect().execute("DELETE FROM auth_codes WHERE expires_at <= ?", (now,)).rowcount
+
+    async def _put(self, code, claims, expires_at):
+        return await run_in_threadpool(self._put_sync, code, claims, expires_at)
+
+    async def _take(self, code):
+        return await run_in_threadpool(self._take_sync, code)
+
+    async def _sweep(self, now):
+        return await run_in_threadpool(self._sweep_sync, now)
+
+    def size(self):
+        return self._connect().execute("SELECT COUNT(*) FROM auth_codes").fetchone()[0]
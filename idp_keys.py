@@ -0,0 +1,288 @@
+import asyncio
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+from starlette.concurrency import run_in_threadpool
+
+# Signing algorithm -> the Authlib key class used for it (Authlib is imported on first use)
+KEY_TYPES = {
+    "RS256": "RSAKey",
+    "PS256": "RSAKey",
+    "ES256": "ECKey",
+    "EdDSA": "OKPKey",
+}
+
+
+def key_type(alg: str):
+    import authlib.jose
+
+    return getattr(authlib.jose, KEY_TYPES[alg])
+
+
+def generate_private_key(alg: str):
+    if alg in ("RS256", "PS256"):
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    if alg == "ES256":
+        return ec.generate_private_key(ec.SECP256R1())
+    if alg == "EdDSA":
+        return ed25519.Ed25519PrivateKey.generate()
+    raise ValueError(f"Unsupported signing algorithm {alg!r}")
+
+
+class SigningKey:
+    """
+    A private signing key plus the public JWK published for it.
+
+    `signer` is the pre-imported Authlib key to hand to `jwt.encode`, so the
+    PEM is parsed once rather than on every token.
+    """
+
+    def __init__(self, private_key, alg: str, created_at: float = 0, activate_at: float = 0):
+        if alg not in KEY_TYPES:
+            raise ValueError(f"Unsupported signing algorithm {alg!r}")
+        self.private_key = private_key
+        self.alg = alg
+        self.created_at = created_at
+        self.activate_at = activate_at
+        self.pem = private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+
+        key_class = key_type(alg)
+        self.signer = key_class.import_key(private_key)
+        jwk = key_class.import_key(private_key.public_key())
+        # The RFC 7638 thumbprint gives every key a stable, distinct 'kid'
+        self.kid = jwk.thumbprint()
+        self.public_jwk = json.loads(jwk.as_json())
+        self.public_jwk.update({'kid': self.kid, 'alg': alg, 'use': 'sig'})
+
+    @classmethod
+    def from_pem(cls, pem, alg: str = "RS256", created_at: float = 0, activate_at: float = 0,
+                 trusted: bool = False) -> "SigningKey":
+        """
+        Load a PKCS8 PEM. `trusted` skips the RSA consistency check, which costs
+        about as much as generating a key; only use it for keys we wrote ourselves.
+        """
+        if isinstance(pem, str):
+            pem = pem.encode("utf-8")
+        private_key = serialization.load_pem_private_key(pem, password=None, unsafe_skip_rsa_key_validation=trusted)
+        return cls(private_key, alg, created_at, activate_at)
+
+    def to_record(self) -> Dict:
+        return {
+            "kid": self.kid,
+            "alg": self.alg,
+            "created_at": self.created_at,
+            "activate_at": self.activate_at,
+            "pem": self.pem.decode("utf-8"),
+        }
+
+
+class KeyRing:
+    """
+    The mock IdP's signing keys.
+
+    Keys come from `IDP_SIGNING_KEY` (a PEM, never rotated) or from a JSON
+    key file shared by every worker on the host; the first worker to start
+    generates the key and the rest load it. With `rotate_after` set a new key
+    is generated once the newest one is that old. It is published in the
+    JWKS `publish_ahead` seconds before it starts signing, and the key it
+    replaces stays published for `retain` seconds afterwards, so tokens and
+    cached keysets on either side of a rotation keep verifying.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        algs=("RS256",),
+        rotate_after: float = 0,
+        publish_ahead: float = 600,
+        retain: float = 3900,
+        keys: Optional[List[SigningKey]] = None,
+    ):
+        self.path = path
+        self.algs = tuple(algs)
+        self.rotate_after = rotate_after
+        self.publish_ahead = publish_ahead
+        self.retain = retain
+        self.keys: List[SigningKey] = list(keys or [])
+        self._loaded = path is None
+        self._load_lock = threading.Lock()
+        self._mtime = None
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_env(cls, algs=("RS256",)) -> "KeyRing":
+        pem = os.environ.get("IDP_SIGNING_KEY")
+        if pem:
+            alg = os.environ.get("IDP_SIGNING_KEY_ALG", "RS256")
+            return cls(algs=(alg,), keys=[SigningKey.from_pem(pem.replace("\\n", "\n"), alg)])
+
+        ring = cls(
+            path=os.environ.get("IDP_KEYS_FILE", "idp_keys.json"),
+            algs=algs,
+            rotate_after=float(os.environ.get("IDP_KEY_ROTATE_HOURS", "0")) * 3600,
+            publish_ahead=float(os.environ.get("IDP_KEY_PUBLISH_AHEAD", "600")),
+            retain=float(os.environ.get("IDP_KEY_RETAIN", "3900")),
+        )
+        # The key file is read (or the first key generated) on first use, not at import
+        return ring
+
+    def load(self) -> None:
+        """Read the key file once, generating the first keys if there are none yet."""
+        if not self._loaded:
+            with self._load_lock:
+                if not self._loaded:
+                    self.sync()
+
+    # --- Selecting keys ---
+
+    def _keys_for(self, alg: str) -> List[SigningKey]:
+        return sorted((k for k in self.keys if k.alg == alg), key=lambda k: k.activate_at)
+
+    def signing_key(self, alg: str = "RS256") -> SigningKey:
+        """The newest key for `alg` whose activation time has passed."""
+        self.load()
+        keys = self._keys_for(alg)
+        if not keys:
+            raise LookupError(f"No signing key for {alg}")
+        now = time.time()
+        active = [k for k in keys if k.activate_at <= now]
+        return active[-1] if active else keys[0]
+
+    def published_keys(self) -> List[SigningKey]:
+        self.load()
+        return self._published()
+
+    def _published(self) -> List[SigningKey]:
+        now = time.time()
+        published = []
+        for alg in self.algs:
+            keys = self._keys_for(alg)
+            for key, successor in zip(keys, keys[1:] + [None]):
+                if successor is None or successor.activate_at + self.retain > now:
+                    published.append(key)
+        return published
+
+    def jwks(self) -> Dict:
+        return {"keys": [key.public_jwk for key in self.published_keys()]}
+
+    @property
+    def version(self) -> str:
+        """
+        Identifies the published key set. It changes whenever a key is added or
+        retired, including keys ageing out of `retain` between two syncs.
+        """
+        return ",".join(key.kid for key in self.published_keys())
+
+    # --- Persistence and rotation ---
+
+    @contextmanager
+    def _locked(self):
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read(self) -> None:
+        try:
+            with open(self.path) as f:
+                records = json.load(f).get("keys", [])
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            records = []
+        self.keys = [
+            SigningKey.from_pem(r["pem"], r["alg"], r.get("created_at", 0), r.get("activate_at", 0), trusted=True)
+            for r in records
+        ]
+
+    def _write(self) -> None:
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"keys": [k.to_record() for k in self.keys]}, f, indent=2)
+        os.replace(tmp, self.path)
+        self._mtime = os.stat(self.path).st_mtime_ns
+
+    def _rotate(self, now: float) -> bool:
+        changed = False
+        for alg in self.algs:
+            keys = self._keys_for(alg)
+            if not keys:
+                # First key for this algorithm: usable straight away
+                self.keys.append(SigningKey(generate_private_key(alg), alg, now, now))
+                changed = True
+            elif self.rotate_after and now - keys[-1].created_at >= self.rotate_after:
+                self.keys.append(SigningKey(generate_private_key(alg), alg, now, now + self.publish_ahead))
+                changed = True
+
+        # Forget keys that are no longer published
+        published = {k.kid for k in self._published()}
+        if len(published) != len(self.keys):
+            self.keys = [k for k in self.keys if k.kid in published]
+            changed = True
+        return changed
+
+    def sync(self) -> bool:
+        """
+        Pick up keys written by other workers and rotate if due.
+        Returns True if the key set changed.
+        """
+        if self.path is None:
+            return False
+
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime is not None and mtime == self._mtime and not self._rotation_due():
+            return False
+
+        before = [k.kid for k in self.keys]
+        with self._locked():
+            self._read()
+            if self._rotate(time.time()):
+                self._write()
+        self._loaded = True
+        return [k.kid for k in self.keys] != before
+
+    def _rotation_due(self) -> bool:
+        now = time.time()
+        for alg in self.algs:
+            keys = self._keys_for(alg)
+            if not keys or (self.rotate_after and now - keys[-1].created_at >= self.rotate_after):
+                return True
+            if len(keys) > 1 and keys[-1].activate_at + self.retain <= now:
+                return True
+        return False
+
+    async def start(self, interval: float = 60) -> None:
+        await run_in_threadpool(self.load)
+        if self.path is not None and self._task is None:
+            self._task = asyncio.create_task(self.run(interval))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run(self, interval: float = 60) -> None:
+        """Background loop keeping this worker's keys in line with the key file."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await run_in_threadpool(self.sync)
+            except Exception as e:
+                print("Error syncing IdP signing keys:", e)
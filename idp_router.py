@@ -1,40 +1,62 @@
-import time
+import os
+import hashlib
 import json
+import time
 import uuid
-from typing import Dict, Any
-from fastapi import APIRouter, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
-# Use the modern Authlib interface
-from authlib.jose import jwt, JsonWebKey
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.primitives import serialization
+from functools import lru_cache
+from typing import Any, Dict, Optional
+from fastapi import APIRouter, Depends, Request, Form, HTTPException
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
 from starlette.responses import PlainTextResponse
 
+from idp_codes import MemoryAuthCodeStore, SQLiteAuthCodeStore
+from idp_keys import KeyRing
+from idp_tokens import TokenMinter, id_token_payload, issuer, sign_id_token
+from metrics import FAST_BUCKETS, GaugeFunc, Histogram
+from profiling import phase
+from ratelimit import BUCKETS, Admission, Rule, client_ip
+from templating import templates
+
 router = APIRouter()
-templates = Jinja2Templates(directory="templates")
 
-# --- IMPROVED KEY GENERATION ---
-# 1. Generate a real RSA Private Key object
-_private_key_obj = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+# --- SIGNING KEYS ---
+# Signing algorithm per mode, e.g. IDP_ALGORITHMS="persona=ES256,expert=EdDSA".
+# Anything not listed signs with IDP_DEFAULT_ALG (RS256, PS256, ES256 or EdDSA).
+IDP_DEFAULT_ALG = os.environ.get("IDP_DEFAULT_ALG", "RS256")
+IDP_ALGORITHMS = dict(
+    item.split("=", 1) for item in os.environ.get("IDP_ALGORITHMS", "").split(",") if "=" in item
+)
 
-# 2. Derive the Public Key object
-_public_key_obj = _private_key_obj.public_key()
 
-# 3. Create a JWK (JSON Web Key) for the /jwks endpoint
-# We add a 'kid' (Key ID) so Keycloak can identify the key
-JWK_PUBLIC = json.loads(JsonWebKey.import_key(_public_key_obj, {'kty': 'RSA'}).as_json())
-JWK_PUBLIC['kid'] = "mock-idp-key-id"
+def signing_alg(mode: str) -> str:
+    return IDP_ALGORITHMS.get(mode, IDP_DEFAULT_ALG)
 
-# 4. Export the Private Key in PEM format for signing tokens
-PRIVATE_KEY_PEM = _private_key_obj.private_bytes(
-    encoding=serialization.Encoding.PEM,
-    format=serialization.PrivateFormat.PKCS8,
-    encryption_algorithm=serialization.NoEncryption()
-)
 
-# --- IN-MEMORY STORAGE ---
-AUTH_CODES: Dict[str, Any] = {}
+IDP_SIGN_SECONDS = Histogram("idp_sign_seconds", "Time spent signing ID tokens", ("alg",),
+                             buckets=FAST_BUCKETS + (0.025, 0.05, 0.1))
+
+
+# Loaded from IDP_SIGNING_KEY or the shared key file (generated on first start),
+# so every worker signs with the same keys. See idp_keys.KeyRing for rotation.
+KEYS = KeyRing.from_env(algs=sorted({IDP_DEFAULT_ALG, *IDP_ALGORITHMS.values()}))
+router.add_event_handler("startup", KEYS.start)
+router.add_event_handler("shutdown", KEYS.stop)
+
+# --- AUTHORIZATION CODES ---
+# "memory" is per worker; "sqlite" lets any worker on the host redeem a code
+IDP_CODE_STORE = os.environ.get("IDP_CODE_STORE", "memory")
+IDP_CODE_DB = os.environ.get("IDP_CODE_DB", "idp_codes.db")
+IDP_CODE_TTL = float(os.environ.get("IDP_CODE_TTL", "60"))
+IDP_CODE_MAX = int(os.environ.get("IDP_CODE_MAX", "10000"))
+IDP_CODE_SWEEP = float(os.environ.get("IDP_CODE_SWEEP", "30"))
+
+if IDP_CODE_STORE == "sqlite":
+    AUTH_CODES = SQLiteAuthCodeStore(IDP_CODE_DB, ttl=IDP_CODE_TTL, max_size=IDP_CODE_MAX, sweep_interval=IDP_CODE_SWEEP)
+else:
+    AUTH_CODES = MemoryAuthCodeStore(ttl=IDP_CODE_TTL, max_size=IDP_CODE_MAX, sweep_interval=IDP_CODE_SWEEP)
+router.add_event_handler("shutdown", AUTH_CODES.stop)
+GaugeFunc("idp_auth_codes", "Outstanding authorization codes and lifetime counters", AUTH_CODES.stats, ("stat",))
 
 PERSONAS = {
     "default": {
@@ -76,6 +98,16 @@ PERSONAS = {
 }
 
 
+def sign_for_mode(mode: str, payload: Dict[str, Any]) -> str:
+    """Sign with the current key for this mode."""
+    key = KEYS.signing_key(signing_alg(mode))
+    start = time.perf_counter()
+    with phase("sign"):
+        token = sign_id_token(key, payload)
+    IDP_SIGN_SECONDS.observe(time.perf_counter() - start, key.alg)
+    return token
+
+
 def get_base_url(request: Request):
     # Dynamically determine base URL from request headers
     return str(request.base_url).rstrip('/')
@@ -94,25 +126,12 @@ async def root_dashboard(request: Request):
 # A simple helper page to show you what the result would have looked like
 @router.get("/{mode}/oidc/callback-preview", response_class=HTMLResponse)
 async def callback_preview(request: Request, code: str, state: str, mode:str):
-    claims = AUTH_CODES.pop(code, None)
+    claims = await AUTH_CODES.take(code)
     payload={}
     if claims:
-        now = int(time.time())
-        base = f"https://jwt.knollfear.com/idp/{mode}/oidc"
-        payload = {
-            "iss": base,
-            "aud": "my-keycloak-client",
-            "iat": now,
-            "exp": now + 3600,
-            "sub": claims.get("sub", "user-default")
-        }
-        payload.update(claims)
-
-        # Sign using the PEM string and the explicit Header
-        header = {'alg': 'RS256', 'kid': JWK_PUBLIC['kid']}
-
-        # Use the PEM key directly for signing
-        token = jwt.encode(header, payload, PRIVATE_KEY_PEM).decode('utf-8')
+        payload = id_token_payload(mode, {"sub": claims.get("sub", "user-default"), **claims})
+
+        token = sign_for_mode(mode, payload)
 
     return f"""
     <div style="font-family:sans-serif; background:#111; color:#eee; padding:2rem; line-height:1.6;">
@@ -138,19 +157,53 @@ async def callback_preview(request: Request, code: str, state: str, mode:str):
     """
 # --- OIDC ENDPOINTS ---
 
-# idp_router.py
+# Relying parties poll discovery and the JWKS constantly, so both are
+# serialized once and served with an ETag. Keep the JWKS max-age below
+# IDP_KEY_PUBLISH_AHEAD so clients see a new key before it signs anything.
+IDP_DISCOVERY_MAX_AGE = int(os.environ.get("IDP_DISCOVERY_MAX_AGE", "3600"))
+IDP_JWKS_MAX_AGE = int(os.environ.get("IDP_JWKS_MAX_AGE", "300"))
 
-@router.get("/{mode}/.well-known/openid-configuration")
-async def discovery(request: Request, mode: str):
+
+class CachedDocument:
+    """A JSON document serialized once, with a strong ETag over its bytes."""
+
+    def __init__(self, content: Dict[str, Any], max_age: int):
+        self.body = json.dumps(content, separators=(",", ":")).encode("utf-8")
+        self.etag = '"' + hashlib.sha256(self.body).hexdigest()[:32] + '"'
+        self.headers = {"ETag": self.etag, "Cache-Control": f"public, max-age={max_age}"}
+
+    def response(self, request: Request) -> Response:
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            # If-None-Match uses weak comparison, so W/ prefixes still match
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or self.etag in tags:
+                return Response(status_code=304, headers=self.headers)
+        return Response(self.body, media_type="application/json", headers=self.headers)
+
+
+@lru_cache(maxsize=64)
+def _discovery_document(mode: str, alg: str) -> CachedDocument:
     # The 'issuer' MUST match the URL Keycloak is configured with
-    base = f"https://jwt.knollfear.com/idp/{mode}/oidc"
-    return {
+    base = issuer(mode)
+    return CachedDocument({
         "issuer": base,
         "authorization_endpoint": f"{base}/authorize",
         "token_endpoint": f"{base}/token",
         "jwks_uri": f"{base}/jwks",
+        "id_token_signing_alg_values_supported": [alg],
         # ... rest of your config
-    }
+    }, IDP_DISCOVERY_MAX_AGE)
+
+
+@lru_cache(maxsize=4)
+def _jwks_document(version: str) -> CachedDocument:
+    return CachedDocument(KEYS.jwks(), IDP_JWKS_MAX_AGE)
+
+
+@router.get("/{mode}/.well-known/openid-configuration")
+async def discovery(request: Request, mode: str):
+    return _discovery_document(mode, signing_alg(mode)).response(request)
 
 
 @router.get("/{mode}/oidc/authorize", response_class=HTMLResponse)
@@ -171,9 +224,9 @@ async def authorize(request: Request, mode: str, redirect_uri: str, state: str,
 
 
 @router.get("/{mode}/oidc/jwks")
-async def jwks():
-    # Wrap the key in the "keys" array standard
-    return {"keys": [JWK_PUBLIC]}
+async def jwks(request: Request):
+    # Every published key, wrapped in the "keys" array standard; rebuilt when the key set changes
+    return _jwks_document(KEYS.version).response(request)
 
 @router.get("/persona-template", response_class=PlainTextResponse)
 async def persona_template(persona: str = "default"):
@@ -192,7 +245,7 @@ mode: str,
 ):
     if mode == "persona":
         # Use the static persona data only
-        claims = PERSONAS.get(persona_choice, PERSONAS['default'])
+        claims = dict(PERSONAS.get(persona_choice, PERSONAS['default']))
     else:
         # Use the raw JSON from the textarea
         claims = json.loads(custom_claims)
@@ -202,33 +255,81 @@ mode: str,
         claims["nonce"] = nonce
 
     code = str(uuid.uuid4())
-    AUTH_CODES[code] = claims
+    await AUTH_CODES.put(code, claims)
     return RedirectResponse(url=f"{redirect_uri}?state={state}&code={code}", status_code=303)
 
 
-@router.post("/{mode}/oidc/token")
+# Every token request is a signature; limit them per client IP ("count/seconds") and in flight per worker
+IDP_TOKEN_RATE_PER_IP = os.environ.get("IDP_TOKEN_RATE_PER_IP", "120/60")
+IDP_TOKEN_MAX_CONCURRENCY = int(os.environ.get("IDP_TOKEN_MAX_CONCURRENCY", "64"))
+TOKEN_ADMISSION = Admission(
+    "idp_token", BUCKETS, {"ip": Rule.parse(IDP_TOKEN_RATE_PER_IP)}, max_concurrency=IDP_TOKEN_MAX_CONCURRENCY,
+)
+
+
+async def admit_token(request: Request):
+    await TOKEN_ADMISSION.admit({"ip": client_ip(request)})
+    try:
+        yield
+    finally:
+        TOKEN_ADMISSION.release()
+
+
+@router.post("/{mode}/oidc/token", dependencies=[Depends(admit_token)])
 async def token(request: Request, mode:str, code: str = Form(...)):
-    claims = AUTH_CODES.pop(code, None)
+    with phase("code"):
+        claims = await AUTH_CODES.take(code)
     if not claims:
         return JSONResponse(status_code=400, content={"error": "invalid_grant"})
 
-    now = int(time.time())
-    payload = {
-        "iss": f"https://jwt.knollfear.com/idp/{mode}/oidc",
-        "aud": "my-keycloak-client",
-        "iat": now,
-        "exp": now + 3600,
-    }
     # This will now include the 'nonce' if it was captured in the previous steps
-    payload.update(claims)
-
-    header = {'alg': 'RS256', 'kid': JWK_PUBLIC['kid']}
-    token_bytes = jwt.encode(header, payload, PRIVATE_KEY_PEM)
-    id_token = token_bytes.decode('utf-8') if isinstance(token_bytes, bytes) else token_bytes
+    payload = id_token_payload(mode, claims)
+    id_token = sign_for_mode(mode, payload)
 
     return {
         "access_token": "mock-access-token",
         "id_token": id_token,
         "token_type": "Bearer",
         "expires_in": 3600
-    }
\ No newline at end of file
+    }
+
+
+# --- BULK MINTING (load testing) ---
+
+# Tokens per bulk request; 0 (the default) disables the endpoint, which can keep every core busy
+IDP_BULK_MAX = int(os.environ.get("IDP_BULK_MAX", "0"))
+IDP_BULK_PROCESSES = int(os.environ.get("IDP_BULK_PROCESSES", "0")) or None
+
+MINTER = TokenMinter(IDP_BULK_PROCESSES)
+router.add_event_handler("shutdown", MINTER.stop)
+
+
+class BulkTokenRequest(BaseModel):
+    persona: str = "default"
+    # Expert mode only; '{n}' in string values becomes the token's index
+    claims: Optional[Dict[str, Any]] = None
+    count: int = Field(1, ge=1)
+
+
+@router.post("/{mode}/oidc/bulk-tokens", dependencies=[Depends(admit_token)])
+async def bulk_tokens(mode: str, body: BulkTokenRequest):
+    """
+    Stream `count` signed ID tokens as NDJSON lines of {"n": ..., "id_token": ...}.
+    Only served when IDP_BULK_MAX is set; each request counts against the
+    /token limits.
+    """
+    if not IDP_BULK_MAX:
+        raise HTTPException(status_code=404, detail="Bulk minting is disabled")
+    if body.count > IDP_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"count may not exceed {IDP_BULK_MAX}")
+
+    if mode == "persona" or body.claims is None:
+        # Same rule as the login form: persona mode only signs the static personas
+        if body.persona not in PERSONAS:
+            raise HTTPException(status_code=400, detail=f"Unknown persona {body.persona!r}")
+        template = PERSONAS[body.persona]
+    else:
+        template = body.claims
+
+    key = KEYS.signing_key(signing_alg(mode))
+    return StreamingResponse(MINTER.ndjson(key, mode, template, body.count), media_type="application/x-ndjson")
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from idp_keys import SigningKey
+
+ISSUER_BASE = "https://jwt.knollfear.com/idp"
+AUDIENCE = "my-keycloak-client"
+TOKEN_LIFETIME = 3600
+
+
+def issuer(mode: str) -> str:
+    return f"{ISSUER_BASE}/{mode}/oidc"
+
+
+def id_token_payload(mode: str, claims: Dict[str, Any], now: Optional[int] = None) -> Dict[str, Any]:
+    """The ID token the IdP issues for `claims`; shared by the token endpoint and bulk minting."""
+    now = int(time.time()) if now is None else now
+    payload = {
+        "iss": issuer(mode),
+        "aud": AUDIENCE,
+        "iat": now,
+        "exp": now + TOKEN_LIFETIME,
+    }
+    payload.update(claims)
+    return payload
+
+
+def sign_id_token(key: SigningKey, payload: Dict[str, Any]) -> str:
+    from authlib.jose import jwt
+
+    header = {'alg': key.alg, 'kid': key.kid}
+    token_bytes = jwt.encode(header, payload, key.signer)
+    return token_bytes.decode('utf-8') if isinstance(token_bytes, bytes) else token_bytes
+
+
+def render_claims(template: Dict[str, Any], n: int) -> Dict[str, Any]:
+    """Replace "{n}" in the template's string values with the token's index."""
+    return {
+        name: value.replace("{n}", str(n)) if isinstance(value, str) else value
+        for name, value in template.items()
+    }
+
+
+# --- Bulk minting ---
+
+# Keys already loaded in this worker process, by kid
+_worker_keys: Dict[str, SigningKey] = {}
+
+
+def _mint_chunk(pem: bytes, alg: str, kid: str, mode: str, template: Dict[str, Any],
+                start: int, count: int) -> List[Tuple[int, str]]:
+    key = _worker_keys.get(kid)
+    if key is None:
+        key = _worker_keys[kid] = SigningKey.from_pem(pem, alg, trusted=True)
+
+    now = int(time.time())
+    return [
+        (n, sign_id_token(key, id_token_payload(mode, render_claims(template, n), now)))
+        for n in range(start, start + count)
+    ]
+
+
+class TokenMinter:
+    """
+    Signs ID tokens in bulk across a pool of worker processes.
+
+    Work is handed out in chunks with at most two chunks per process in
+    flight, so results can be streamed back without holding the whole batch
+    in memory.
+    """
+
+    def __init__(self, processes: Optional[int] = None, chunk_size: int = 250):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunk_size = chunk_size
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # spawn: forking a process that runs an event loop and threads is unsafe
+            self._pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+        return self._pool
+
+    async def mint(self, key: SigningKey, mode: str, template: Dict[str, Any],
+                   count: int) -> AsyncIterator[List[Tuple[int, str]]]:
+        """Yield (n, token) pairs a chunk at a time, in completion order."""
+        loop = asyncio.get_running_loop()
+        pool = self._executor()
+        chunks = iter(range(0, count, self.chunk_size))
+        pending = set()
+
+        def submit():
+            start = next(chunks, None)
+            if start is not None:
+                size = min(self.chunk_size, count - start)
+                pending.add(asyncio.wrap_future(
+                    pool.submit(_mint_chunk, key.pem, key.alg, key.kid, mode, template, start, size), loop=loop,
+                ))
+
+        for _ in range(self.processes * 2):
+            submit()
+
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    pending.discard(future)
+                    submit()
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def ndjson(self, key: SigningKey, mode: str, template: Dict[str, Any], count: int) -> AsyncIterator[bytes]:
+        async for chunk in self.mint(key, mode, template, count):
+            yield "".join(json.dumps({"n": n, "id_token": token}) + "\n" for n, token in chunk).encode("utf-8")
+
+    async def stop(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+def main():
+    """
+    Mint tokens from the command line, signed with the same keys as the IdP:
+
+        python -m idp_tokens --persona admin --count 10000 > tokens.ndjson
+        python -m idp_tokens --mode expert --claims '{"sub": "load-{n}"}' --count 500
+    """
+    import argparse
+    import sys
+
+    import idp_router
+    import idp_tokens
+
+    parser = argparse.ArgumentParser(description="Mint mock IdP ID tokens as NDJSON")
+    parser.add_argument("--mode", default="persona")
+    parser.add_argument("--persona", default="default", choices=sorted(idp_router.PERSONAS))
+    parser.add_argument("--claims", help="JSON claim template; '{n}' in string values becomes the token index")
+    parser.add_argument("--count", type=int, default=1)
+    parser.add_argument("--processes", type=int)
+    args = parser.parse_args()
+
+    template = json.loads(args.claims) if args.claims else idp_router.PERSONAS[args.persona]
+    key = idp_router.KEYS.signing_key(idp_router.signing_alg(args.mode))
+    minter = idp_tokens.TokenMinter(args.processes)
+
+    async def run():
+        try:
+            async for lines in minter.ndjson(key, args.mode, template, args.count):
+                sys.stdout.buffer.write(lines)
+        finally:
+            await minter.stop()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
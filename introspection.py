@@ -0,0 +1,39 @@
+import os
+from typing import Any, Dict, List
+
+from middleware import JWTAuthMiddleware
+from permissions import parse_permissions
+
+# Tokens per introspection request, and how many are verified per threadpool job
+INTROSPECT_MAX_TOKENS = int(os.environ.get("INTROSPECT_MAX_TOKENS", "1000"))
+INTROSPECT_CHUNK_SIZE = int(os.environ.get("INTROSPECT_CHUNK_SIZE", "64"))
+
+# Same defaults as the app's middleware: the same payload cache, trusted keysets and denylist
+VERIFIER = JWTAuthMiddleware(None)
+
+
+def _result(payload, reason, claims: List[str]) -> Dict[str, Any]:
+    if payload is None:
+        return {"active": False, "reason": reason, "allowed": False, "decisions": {claim: False for claim in claims}}
+
+    # Same rule as claim_required: every required claim must be granted, whatever the token's encoding
+    permissions = parse_permissions(payload)
+    decisions = {claim: claim in permissions for claim in claims}
+    return {
+        "active": True,
+        "claims": payload,
+        "permissions": sorted(permissions),
+        "allowed": all(decisions.values()),
+        "decisions": decisions,
+    }
+
+
+async def introspect(tokens: List[str], claims: List[str], verifier: JWTAuthMiddleware = VERIFIER) -> List[Dict[str, Any]]:
+    """
+    Check `tokens` the way `JWTAuthMiddleware` and `claim_required` would,
+    and return one result per token, in order. Identical tokens are checked
+    once; see `JWTAuthMiddleware.check_many`.
+    """
+    checked = await verifier.check_many(tokens, INTROSPECT_CHUNK_SIZE)
+    decided = {token: _result(*checked[token], claims) for token in checked}
+    return [decided[token] for token in tokens]
@@ -0,0 +1,139 @@
+import asyncio
+import time
+from typing import Callable, Dict, Optional, Union
+
+import jwt
+from starlette.concurrency import run_in_threadpool
+
+# A JWKS URL, or a function returning the JWKS dict (for an IdP in this process)
+JWKSSource = Union[str, Callable[[], Dict]]
+
+
+class JWKSCache:
+    """
+    Public keys of trusted issuers, pre-parsed and indexed by issuer and kid.
+
+    `get` is a dict lookup and never does I/O. Keysets are refreshed by a
+    background task every `refresh_interval` seconds; a token carrying an
+    unknown kid (say, right after the issuer rotated) schedules an early
+    refresh, at most once every `min_refresh_interval` seconds, and is
+    rejected in the meantime.
+    """
+
+    def __init__(
+        self,
+        issuers: Optional[Dict[str, JWKSSource]] = None,
+        refresh_interval: float = 300,
+        min_refresh_interval: float = 30,
+        timeout: float = 5,
+    ):
+        self.issuers: Dict[str, JWKSSource] = dict(issuers or {})
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+
+        self.refreshes = 0
+        self.errors = 0
+        self.unknown_keys = 0
+
+        self._keys: Dict[str, Dict[str, jwt.PyJWK]] = {}
+        self._last_refresh = 0.0
+        self._session = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def add_issuer(self, issuer: str, source: JWKSSource) -> None:
+        self.issuers[issuer] = source
+
+    def __bool__(self) -> bool:
+        return bool(self.issuers)
+
+    # --- Lookups (request path) ---
+
+    def get(self, issuer: str, kid: Optional[str]) -> Optional[jwt.PyJWK]:
+        keys = self._keys.get(issuer)
+        if keys is None:
+            return None
+        key = keys.get(kid) if kid is not None else (next(iter(keys.values())) if len(keys) == 1 else None)
+        if key is None:
+            self.unknown_keys += 1
+            self.request_refresh()
+        return key
+
+    def request_refresh(self) -> None:
+        if self._wakeup is not None and time.monotonic() - self._last_refresh >= self.min_refresh_interval:
+            self._wakeup.set()
+
+    # --- Refreshing (background) ---
+
+    def _load(self, source: JWKSSource) -> Dict:
+        if callable(source):
+            return source()
+        if self._session is None:
+            import requests
+
+            self._session = requests.Session()
+        response = self._session.get(source, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    @staticmethod
+    def _parse(jwks: Dict) -> Dict[str, jwt.PyJWK]:
+        keys = {}
+        for data in jwks.get("keys", []):
+            if data.get("use", "sig") != "sig":
+                continue
+            try:
+                keys[data.get("kid")] = jwt.PyJWK(data)
+            except jwt.PyJWKError as e:
+                print("Skipping unusable JWK", data.get("kid"), e)
+        return keys
+
+    def refresh(self) -> bool:
+        """Reload every issuer's keyset (blocking). A failed issuer keeps its previous keys."""
+        ok = True
+        keys = dict(self._keys)
+        for issuer, source in self.issuers.items():
+            try:
+                keys[issuer] = self._parse(self._load(source))
+            except Exception as e:
+                print("Error refreshing JWKS for", issuer, e)
+                self.errors += 1
+                ok = False
+        self._keys = keys
+        self._last_refresh = time.monotonic()
+        self.refreshes += 1
+        return ok
+
+    async def start(self) -> None:
+        if self.issuers and self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            self._wakeup = None
+
+    async def run(self) -> None:
+        """Refresh straight away, then on schedule or when an unknown kid turns up."""
+        while True:
+            ok = await run_in_threadpool(self.refresh)
+            # Retry sooner while an issuer is unreachable (e.g. our own IdP before we listen)
+            interval = self.refresh_interval if ok else self.min_refresh_interval
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "issuers": len(self.issuers),
+            "keys": sum(len(keys) for keys in self._keys.values()),
+            "refreshes": self.refreshes,
+            "errors": self.errors,
+            "unknown_keys": self.unknown_keys,
+        }
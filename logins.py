@@ -0,0 +1,259 @@
+"""
+Magic-link logins: building the token and the email for one address, and
+issuing them in bulk.
+
+`/request-login` and the bulk API / CLI both go through `mint_login_token`
+and `login_mail`, so a token issued in bulk is identical to one requested
+through the form.
+"""
+import asyncio
+import csv
+import io
+import json
+import os
+import re
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import jwt
+
+from Services.email import MAIL_BATCH_SIZE, build_mail, mail_queue
+from Services.token_store import LoginTokenStore, LoginTokenStoreError
+from permissions import encode_permissions
+
+APP_URL = os.environ.get("RAILWAY_PUBLIC_DOMAIN")
+SECRET_KEY =  os.environ.get("SECRET_KEY", "your_super_secret_key") # load from env in real life
+ALGORITHM = "HS256"
+# Put permissions in the token as a compact bitset ("pbits") instead of a comma joined string
+JWT_COMPACT_PERMISSIONS = os.environ.get("JWT_COMPACT_PERMISSIONS", "0") == "1"
+# How long a magic link stays usable (5 minutes for E-mail verification)
+LOGIN_LINK_TTL = int(os.environ.get("LOGIN_LINK_TTL", "300"))
+
+# Bulk issuance: rows per request, token store writes in flight, default token lifetime in minutes
+BULK_LOGIN_MAX = int(os.environ.get("BULK_LOGIN_MAX", "10000"))
+BULK_LOGIN_CONCURRENCY = int(os.environ.get("BULK_LOGIN_CONCURRENCY", "16"))
+BULK_LOGIN_EXPIRE_IN = int(os.environ.get("BULK_LOGIN_EXPIRE_IN", "60"))
+
+
+def login_payload(email: str, expire_in: int, permissions: Iterable[str]) -> Dict[str, Any]:
+    """Claims of a login token for `email`, valid for `expire_in` minutes."""
+    permissions = list(permissions)
+    if "read_loggedIn" not in permissions:
+        permissions.append("read_loggedIn") # always give this permission
+    now = int(time.time())
+    payload = {
+        "user_id": str(uuid.uuid4()),
+        "username": email,
+        "exp": now + expire_in * 60,
+        "iat": now, # start of the session, for sliding renewal
+    }
+    if JWT_COMPACT_PERMISSIONS:
+        payload.update(encode_permissions(permissions))
+    else:
+        payload["permissions"] = ",".join(permissions)
+    return payload
+
+
+def mint_login_token(email: str, expire_in: int, permissions: Iterable[str]) -> Tuple[str, str]:
+    """Returns (request_id, signed token); the request_id names the magic link."""
+    payload = login_payload(email, expire_in, permissions)
+    return payload["user_id"], jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
+
+
+def login_mail(email: str, login_link_path: str) -> Dict:
+    # Build the link we email to the user:
+    login_link = APP_URL + login_link_path
+
+    body = f"""
+    <div>
+        <div>Thanks for Joining the JWT experience.</div>
+        <div><a href="{login_link}">Click Here</a></div>
+        <div>to retrieve your login token.</div>
+
+    </div>
+    """
+    return build_mail([email,], "Welcome to the JWT Experience", body)
+
+
+# --- BULK ISSUANCE ---
+
+class BulkLoginRow:
+    __slots__ = ("row", "email", "permissions", "expire_in", "error")
+
+    def __init__(self, row: int, email: str, permissions: List[str], expire_in: int, error: Optional[str] = None):
+        self.row = row
+        self.email = email
+        self.permissions = permissions
+        self.expire_in = expire_in
+        self.error = error
+
+    def status(self, status: str, error: Optional[str] = None) -> Dict[str, Any]:
+        line = {"row": self.row, "email": self.email, "status": status}
+        if error or self.error:
+            line["error"] = error or self.error
+        return line
+
+
+def _row(n: int, data: Dict[str, Any]) -> BulkLoginRow:
+    email = str(data.get("email") or "").strip()
+    permissions = data.get("permissions") or []
+    if isinstance(permissions, str):
+        # "read_foo,write_bar", "read_foo;write_bar" or space separated, so CSV cells need no quoting
+        permissions = re.split(r"[,;\s]+", permissions)
+    permissions = [str(p).strip() for p in permissions if str(p).strip()]
+
+    row = BulkLoginRow(n, email, permissions, BULK_LOGIN_EXPIRE_IN)
+    try:
+        if data.get("expire_in") not in (None, ""):
+            row.expire_in = int(data["expire_in"])
+    except (TypeError, ValueError):
+        row.error = "expire_in must be a whole number of minutes"
+    if "@" not in email:
+        row.error = "not an email address"
+    elif row.expire_in <= 0:
+        row.error = "expire_in must be positive"
+    return row
+
+
+def parse_bulk_rows(content: str, content_type: str = "") -> List[BulkLoginRow]:
+    """
+    Rows from a JSON list (of email strings or {"email", "permissions",
+    "expire_in"} objects) or a CSV with an `email` header and optional
+    `permissions` and `expire_in` columns. Invalid rows are kept, with
+    `error` set, so they can be reported in order.
+    """
+    if "json" in content_type or content.lstrip().startswith("["):
+        items = json.loads(content)
+        if not isinstance(items, list):
+            raise ValueError("Expected a JSON list of rows")
+        records = [item if isinstance(item, dict) else {"email": item} for item in items]
+    else:
+        reader = csv.DictReader(io.StringIO(content))
+        if not reader.fieldnames or "email" not in [name.strip() for name in reader.fieldnames]:
+            raise ValueError("CSV needs an 'email' header")
+        records = [{(k or "").strip(): v for k, v in record.items()} for record in reader]
+    return [_row(n, record) for n, record in enumerate(records, 1)]
+
+
+async def _store(login_tokens: LoginTokenStore, row: BulkLoginRow, limit: asyncio.Semaphore, admit):
+    async with limit:
+        if admit is not None and not await admit(row):
+            return row, None, "rate_limited", None
+        request_id, token = mint_login_token(row.email, row.expire_in, row.permissions)
+        try:
+            path = await login_tokens.put(request_id, token, ttl=LOGIN_LINK_TTL)
+        except LoginTokenStoreError as e:
+            return row, None, "store_failed", str(e)
+        return row, login_mail(row.email, path), None, None
+
+
+async def issue_logins(
+    login_tokens: LoginTokenStore,
+    rows: List[BulkLoginRow],
+    concurrency: int = BULK_LOGIN_CONCURRENCY,
+    batch_size: int = MAIL_BATCH_SIZE,
+    admit: Optional[Callable[[BulkLoginRow], Awaitable[bool]]] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Issue a magic link per row and yield one status dict per row as it
+    settles: "invalid", "rate_limited", "store_failed", "sent" or
+    "send_failed". Rows for which `admit` returns False are rate_limited.
+
+    At most `concurrency` token store writes are in flight; stored rows are
+    emailed through the provider's batch endpoint `batch_size` at a time,
+    while the next writes carry on.
+    """
+    limit = asyncio.Semaphore(concurrency)
+    tasks = []
+    for row in rows:
+        if row.error:
+            yield row.status("invalid")
+        else:
+            tasks.append(asyncio.create_task(_store(login_tokens, row, limit, admit)))
+
+    pending: List[Tuple[BulkLoginRow, Dict]] = []
+    sending: Optional[asyncio.Task] = None
+
+    async def flush(batch):
+        results = await mail_queue.send([mail for _, mail in batch])
+        return [row.status("sent" if ok else "send_failed") for (row, _), ok in zip(batch, results)]
+
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            row, mail, status, error = await next_done
+            if mail is None:
+                yield row.status(status, error)
+                continue
+            pending.append((row, mail))
+            if len(pending) >= batch_size:
+                # One batch in flight at a time; the store writes keep going meanwhile
+                if sending is not None:
+                    for line in await sending:
+                        yield line
+                sending = asyncio.create_task(flush(pending))
+                pending = []
+
+        if sending is not None:
+            for line in await sending:
+                yield line
+            sending = None
+        if pending:
+            for line in await flush(pending):
+                yield line
+    finally:
+        for task in tasks:
+            task.cancel()
+        if sending is not None:
+            sending.cancel()
+
+
+async def issue_logins_ndjson(login_tokens: LoginTokenStore, rows: List[BulkLoginRow], admit=None) -> AsyncIterator[bytes]:
+    async for line in issue_logins(login_tokens, rows, admit=admit):
+        yield (json.dumps(line) + "\n").encode("utf-8")
+
+
+def main():
+    """
+    Issue magic links from the command line, through the same token store
+    and mail provider settings as the app:
+
+        python -m logins team.csv > status.ndjson
+        python -m logins team.json --concurrency 32
+    """
+    import argparse
+    import sys
+    from collections import Counter
+
+    parser = argparse.ArgumentParser(description="Email magic links to a list of addresses")
+    parser.add_argument("file", help="CSV (email,permissions,expire_in) or JSON list; '-' reads stdin")
+    parser.add_argument("--concurrency", type=int, default=BULK_LOGIN_CONCURRENCY)
+    args = parser.parse_args()
+
+    import main as app_main
+
+    if app_main.LOGIN_TOKEN_STORE == "memory":
+        sys.exit("LOGIN_TOKEN_STORE=memory: links issued here could never be redeemed by the app")
+
+    content = sys.stdin.read() if args.file == "-" else open(args.file).read()
+    rows = parse_bulk_rows(content, "json" if args.file.endswith(".json") else "")
+    login_tokens = app_main.build_login_tokens()
+
+    async def run():
+        totals = Counter()
+        try:
+            async for line in issue_logins(login_tokens, rows, args.concurrency):
+                totals[line["status"]] += 1
+                sys.stdout.write(json.dumps(line) + "\n")
+                sys.stdout.flush()
+        finally:
+            await login_tokens.close()
+        print(", ".join(f"{status}: {count}" for status, count in sorted(totals.items())), file=sys.stderr)
+        return totals
+
+    totals = asyncio.run(run())
+    sys.exit(1 if set(totals) - {"sent"} else 0)
+
+
+if __name__ == "__main__":
+    main()
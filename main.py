@@ -1,47 +1,101 @@
 # main.py
-from datetime import datetime, timedelta
-from urllib.parse import urlparse
-
-from Services.email import send_mail
-from decorators import claim_required
-
-import requests
-from botocore.exceptions import ClientError
-from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.templating import Jinja2Templates
+from contextlib import asynccontextmanager
+
+from Services.email import MailQueueFull, mail_queue
+from Services.storage import S3Storage
+from Services.token_store import (
+    LoginTokenStore,
+    LoginTokenStoreError,
+    MemoryLoginTokenStore,
+    MemoryNonceSet,
+    S3LoginTokenStore,
+    SignedLoginTokenStore,
+    SQLiteLoginTokenStore,
+    SQLiteNonceSet,
+)
+from decorators import claim_required, get_permissions
+from permissions import ROLE_POLICY, requestable
+from profiling import PROFILE_ENABLED, PROFILE_SLOW_MS, PROFILER, ProfilingMiddleware, phase, recent
+from logins import (
+    BULK_LOGIN_MAX,
+    LOGIN_LINK_TTL,
+    SECRET_KEY,
+    issue_logins_ndjson,
+    login_mail,
+    mint_login_token,
+    parse_bulk_rows,
+)
+from introspection import INTROSPECT_MAX_TOKENS, introspect
+from ratelimit import BUCKETS, Admission, Rule, client_ip
+
+from fastapi import APIRouter, Depends, FastAPI, Request, Form, HTTPException
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel
 from typing import List, Optional
-import boto3
+import asyncio
 import os
-import uuid
-import resend
+import time
 import jwt
-from idp_router import router as idp_router
-from middleware import JWTAuthMiddleware
+import metrics
+from middleware import JWKS, RENEWER, REVOCATIONS, JWTAuthMiddleware
+from renewal import token_max_age
+from revocation import revocation_keys
+from templating import precompile, static_page, templates
 
-resend.api_key = os.environ.get("RESEND_API_KEY")
 ACCESS_KEY_ID= os.environ.get('AWS_ACCESS_KEY_ID')
 SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
 BUCKET_NAME = os.environ.get('AWS_S3_BUCKET_NAME')
 ENDPOINT_URL = os.environ.get('AWS_ENDPOINT_URL')
-S3_BASE = "https://storage.railway.app/optimized-eclair-jtgu25gw"
-APP_URL = os.environ.get("RAILWAY_PUBLIC_DOMAIN")
+S3_BASE = os.environ.get("S3_BASE", "https://storage.railway.app/optimized-eclair-jtgu25gw")
 RAILWAY_ENVIRONMENT_NAME = os.environ.get("RAILWAY_ENVIRONMENT_NAME")
-SECRET_KEY =  os.environ.get("SECRET_KEY", "your_super_secret_key") # load from env in real life
-ALGORITHM = "HS256"
-
-
-s3_client = boto3.client('s3', endpoint_url=ENDPOINT_URL, aws_access_key_id=ACCESS_KEY_ID, aws_secret_access_key=SECRET_ACCESS_KEY)
-
-app = FastAPI()
-app.add_middleware(JWTAuthMiddleware)
-
-templates = Jinja2Templates(directory="templates")
-
-app.mount("/static", StaticFiles(directory="static"), name="static")
-app.include_router(idp_router, prefix="/idp", tags=["MockIdP"])
-@app.get("/", response_class=HTMLResponse)
+LOGIN_TOKEN_STORE = os.environ.get("LOGIN_TOKEN_STORE", "s3")  # s3, sqlite, memory or signed
+LOGIN_TOKEN_DB = os.environ.get("LOGIN_TOKEN_DB", "login_tokens.db")
+# LOGIN_TOKEN_STORE=signed: key for the grants carried in the links, and where used grants are
+# remembered ("sqlite" in LOGIN_TOKEN_DB, shared by the host's workers, or "memory" per worker)
+LOGIN_GRANT_SECRET = os.environ.get("LOGIN_GRANT_SECRET", SECRET_KEY)
+LOGIN_GRANT_NONCES = os.environ.get("LOGIN_GRANT_NONCES", "sqlite")
+# Token buckets ("count/seconds") for /request-login, per client IP and per email address,
+# plus a cap on logins in flight per worker
+LOGIN_RATE_PER_IP = os.environ.get("LOGIN_RATE_PER_IP", "20/60")
+LOGIN_RATE_PER_EMAIL = os.environ.get("LOGIN_RATE_PER_EMAIL", "3/300")
+LOGIN_MAX_CONCURRENCY = int(os.environ.get("LOGIN_MAX_CONCURRENCY", "64"))
+# /bulk-login requests per client IP and in flight per worker; each row also draws from the
+# per-email bucket of /request-login
+BULK_LOGIN_RATE_PER_IP = os.environ.get("BULK_LOGIN_RATE_PER_IP", "10/3600")
+BULK_LOGIN_MAX_REQUESTS = int(os.environ.get("BULK_LOGIN_MAX_REQUESTS", "1"))
+# How long a revocation lasts when the caller doesn't know the token's exp
+REVOCATION_MAX_TTL = float(os.environ.get("REVOCATION_MAX_TTL", str(30 * 24 * 3600)))
+# Serve the mock IdP under /idp; "0" leaves it (and Authlib) out of the app entirely
+IDP_ENABLED = os.environ.get("IDP_ENABLED", "1") == "1"
+# Mock IdP modes whose ID tokens this app accepts, e.g. "persona,expert" (keys are read in-process)
+JWT_TRUST_MOCK_IDP = [m for m in os.environ.get("JWT_TRUST_MOCK_IDP", "").split(",") if m]
+
+
+def build_login_tokens() -> LoginTokenStore:
+    if LOGIN_TOKEN_STORE == "memory":
+        return MemoryLoginTokenStore()
+    if LOGIN_TOKEN_STORE == "sqlite":
+        return SQLiteLoginTokenStore(LOGIN_TOKEN_DB)
+    if LOGIN_TOKEN_STORE == "signed":
+        nonces = MemoryNonceSet() if LOGIN_GRANT_NONCES == "memory" else SQLiteNonceSet(LOGIN_TOKEN_DB)
+        return SignedLoginTokenStore(LOGIN_GRANT_SECRET, nonces)
+    # boto3 is only imported when the first token is stored
+    storage = S3Storage(BUCKET_NAME, endpoint_url=ENDPOINT_URL, aws_access_key_id=ACCESS_KEY_ID, aws_secret_access_key=SECRET_ACCESS_KEY)
+    return S3LoginTokenStore(storage, S3_BASE)
+
+
+router = APIRouter()
+
+# Example permissions
+AVAILABLE_PERMISSIONS = (
+    ("read_foo", "Read /foo"),
+    ("write_foo", "Write /foo"),
+    ("read_bar", "Read /bar"),
+    ("write_bar", "Write /bar"),
+)
+
+@router.get("/", response_class=HTMLResponse)
 async def show_signup(request: Request, message: Optional[str] = None):
     if request.state.token_payload is not None:
         redirect_url = "/logged-in"  # your logged-in homepage
@@ -51,30 +105,40 @@ async def show_signup(request: Request, message: Optional[str] = None):
     msg = request.query_params.get("msg")
     need = request.query_params.get("need")
 
-    alert = None
     if msg == "missing_claim" and need:
         alert = f"You were redirected because you do not have the '{need}' permission."
-    elif msg == "missing_token":
-        alert = "You must be logged in to view that page."
-
-    # Example permissions
-    available_permissions = [
-        ("read_foo", "Read /foo"),
-        ("write_foo", "Write /foo"),
-        ("read_bar", "Read /bar"),
-        ("write_bar", "Write /bar"),
-    ]
-    return templates.TemplateResponse(
-        "signup.html",
-        {
-            "request": request,
-            "message": alert,
-            "available_permissions": available_permissions,
-        },
-    )
+        return templates.TemplateResponse(
+            "signup.html",
+            {
+                "request": request,
+                "message": alert,
+                "available_permissions": AVAILABLE_PERMISSIONS,
+            },
+        )
+
+    # Every other variant of the page is fixed, so it is rendered once and cached
+    alert = "You must be logged in to view that page." if msg == "missing_token" else None
+    return static_page("signup.html", message=alert, available_permissions=AVAILABLE_PERMISSIONS)
+
+
+LOGIN_ADMISSION = Admission(
+    "request_login",
+    BUCKETS,
+    {"ip": Rule.parse(LOGIN_RATE_PER_IP), "email": Rule.parse(LOGIN_RATE_PER_EMAIL)},
+    max_concurrency=LOGIN_MAX_CONCURRENCY,
+)
+
+
+async def admit_login(request: Request, email: str = Form(...)):
+    # Runs before request_login, so a rejected request never touches storage or email
+    await LOGIN_ADMISSION.admit({"ip": client_ip(request), "email": email.strip().lower()})
+    try:
+        yield
+    finally:
+        LOGIN_ADMISSION.release()
 
 
-@app.post("/request-login", response_class=HTMLResponse)
+@router.post("/request-login", response_class=HTMLResponse, dependencies=[Depends(admit_login)])
 async def request_login(
     request: Request,
     email: str = Form(...),
@@ -84,71 +148,33 @@ async def request_login(
     """
     Handle the form submission:
     - Generate UUID
-    - Generate JWT and upload to S3 as <UUID>.jwt
-    - Send email via Resend with signed link containing UUID
+    - Generate JWT and store it (S3 as <UUID>.jwt by default) for the magic link
+    - Queue an email via Resend with signed link containing UUID
     """
+    if mail_queue.full():
+        # Don't store a token we can't send out
+        raise HTTPException(status_code=503, detail="Too many pending emails, try again shortly")
 
-    request_id = str(uuid.uuid4())
-    permissions.append("read_loggedIn") # always give this permission
-    payload = {
-        "user_id": request_id,
-        "username": email,
-        "exp": datetime.now() + timedelta(minutes=expire_in),  # Expiration time (1 hour from now)
-        "permissions": ",".join(permissions),
-    }
-
-    encoded_jwt = jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
-
-
-    object_key = f"{request_id}.jwt"
+    # Admin claims can't be self-granted: anyone can submit this form
+    permissions = requestable(permissions)
+    request_id, encoded_jwt = mint_login_token(email, expire_in, permissions)
 
     try:
-        # 2. Upload the signed JWT to S3
-        s3_client.put_object(
-            Bucket=BUCKET_NAME,
-            Key=object_key,
-            Body=encoded_jwt.encode("utf-8"),  # bytes
-            ContentType="application/jwt",  # optional but nice
-            Expires=datetime.now() + timedelta(minutes=5), # 5 minutes for E-mail verification
-        )
-    except ClientError as e:
+        # 2. Store the signed JWT until the link is used
+        with phase("store"):
+            login_link_path = await request.app.state.login_tokens.put(request_id, encoded_jwt, ttl=LOGIN_LINK_TTL)
+    except LoginTokenStoreError as e:
         # Log and handle the error however you like
         # For a POC you can just raise HTTPException
-        print("Error uploading JWT to S3:", e)
+        print("Error storing login token:", e)
         raise HTTPException(status_code=500, detail="Failed to store login token")
 
-
-
     try:
-        presigned = s3_client.generate_presigned_url(
-            "get_object",
-            Params={
-                "Bucket": BUCKET_NAME,
-                "Key": object_key,
-            },
-            ExpiresIn=60*5,  # seconds
-        )
-    except ClientError as e:
-        print("Error creating presigned URL:", e)
-        raise
-
-    # We only need the query string part (all the X-Amz-* params, etc.)
-    parsed = urlparse(presigned)
-    query_string = parsed.query  # e.g. "X-Amz-Algorithm=...&X-Amz-Credential=...&..."
-
-    # Build the link we email to the user:
-    login_link_path = f"/jwt/{request_id}.jwt?{query_string}"
-    login_link = APP_URL + login_link_path
-
-    body = f"""
-    <div>
-        <div>Thanks for Joining the JWT experience.</div>
-        <div><a href="{login_link}">Click Here</a></div>
-        <div>to retrieve your login token.</div>
-
-    </div>
-    """
-    send_mail([email,], "Welcome to the JWT Experience", body)
+        with phase("mail"):
+            mail_queue.submit(login_mail(email, login_link_path))
+    except MailQueueFull as e:
+        print("Error queueing login email:", e)
+        raise HTTPException(status_code=503, detail="Too many pending emails, try again shortly")
 
     # Simple confirmation message for the user
     message = (
@@ -156,36 +182,22 @@ async def request_login(
         f"Requested permissions: {', '.join(permissions) or 'none'}"
     )
 
-    return templates.TemplateResponse(
-        "thankyou.html",
-        {"request": request,},
-    )
+    return static_page("thankyou.html")
 
-@app.get("/jwt/{request_id}.jwt")
+@router.get("/jwt/{request_id}.jwt")
 async def proxy_jwt(request_id: str, request: Request):
-    # 1. Grab the query string (all the presigned URL params)
-    query_string = request.url.query
-    if not query_string:
-        raise HTTPException(status_code=403, detail="Missing S3 signature parameters")
-
-    # 2. Reconstruct the exact S3 URL we want to call
-    object_key = f"{request_id}.jwt"
-    s3_url = f"{S3_BASE}/{object_key}?{query_string}"
-
-    # 3. Call S3 with that URL
+    # 1. Hand the query string (presigned URL params for S3) to the store
     try:
-        s3_response = requests.get(s3_url, timeout=5)
-    except requests.RequestException as e:
-        print("Error contacting S3:", e)
+        jwt_token = await request.app.state.login_tokens.take(request_id, request.url.query)
+    except LoginTokenStoreError as e:
+        print("Error contacting storage:", e)
         raise HTTPException(status_code=502, detail="Error contacting storage")
 
-    if s3_response.status_code != 200:
-        # S3 will return 403/400/etc if the signature is invalid or expired
+    if jwt_token is None:
+        # Unknown, expired, already used, or (for S3) a bad signature
         raise HTTPException(status_code=403, detail="Invalid or expired login link")
 
-    jwt_token = s3_response.content.decode("utf-8")
-
-    # 4. Set cookie and redirect to logged-in page
+    # 2. Set cookie and redirect to logged-in page
     redirect_url = "/logged-in"  # your logged-in homepage
     response = RedirectResponse(url=redirect_url, status_code=302)
 
@@ -196,12 +208,18 @@ async def proxy_jwt(request_id: str, request: Request):
         secure=RAILWAY_ENVIRONMENT_NAME == "production",       # only over HTTPS in real environments
         samesite="lax",
         path="/",
-        max_age=60 * 60,   # todo, match this up to the token claim
+        max_age=token_max_age(jwt.decode(jwt_token, options={"verify_signature": False}).get("exp")),  # expires with the token
     )
 
     return response
 
-@app.get("/logged-in", response_class=HTMLResponse)
+@router.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    # Per-process numbers: with several workers each scrape sees one of them
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/logged-in", response_class=HTMLResponse)
 @claim_required("read_loggedIn")
 async def logged_in(request: Request):
     return templates.TemplateResponse(
@@ -209,12 +227,13 @@ async def logged_in(request: Request):
         {"request": request,},
     )
 
-@app.get("/logged-in/claim/{op}/{entity}", response_class=HTMLResponse)
+@router.get("/logged-in/claim/{op}/{entity}", response_class=HTMLResponse)
 @claim_required("{op}_{entity}")
 async def logged_in(op:str, entity:str, request: Request):
     required_claim = f"{op}_{entity}"
     payload = getattr(request.state, "token_payload", {}) or {}
-    permissions = payload.get("permissions", []) or []
+    # Readable whichever encoding the token used
+    permissions = get_permissions(request).readable()
     email = payload.get("sub")
 
     return templates.TemplateResponse(
@@ -229,8 +248,8 @@ async def logged_in(op:str, entity:str, request: Request):
         },
     )
 
-@app.get("/logged-in/showToken", response_class=HTMLResponse)
-@claim_required("loggedIn")
+@router.get("/logged-in/showToken", response_class=HTMLResponse)
+@claim_required("read_loggedIn")
 async def logged_in(request: Request):
     payload = request.cookies.get('auth_token')
 
@@ -242,8 +261,8 @@ async def logged_in(request: Request):
          </div>"""
     )
 
-@app.get("/logged-in/hideToken", response_class=HTMLResponse)
-@claim_required("loggedIn")
+@router.get("/logged-in/hideToken", response_class=HTMLResponse)
+@claim_required("read_loggedIn")
 async def logged_in(request: Request):
 
     return HTMLResponse(
@@ -251,9 +270,121 @@ async def logged_in(request: Request):
         <div id=showToken></div>"""
     )
 
-@app.get("/logout", response_class=HTMLResponse)
-@claim_required("loggedIn")
+BULK_LOGIN_ADMISSION = Admission(
+    "bulk_login", BUCKETS, {"ip": Rule.parse(BULK_LOGIN_RATE_PER_IP)}, max_concurrency=BULK_LOGIN_MAX_REQUESTS,
+)
+
+
+async def admit_bulk_login(request: Request):
+    await BULK_LOGIN_ADMISSION.admit({"ip": client_ip(request)})
+    try:
+        yield
+    finally:
+        BULK_LOGIN_ADMISSION.release()
+
+
+async def admit_bulk_row(row) -> bool:
+    return await LOGIN_ADMISSION.allows({"email": row.email.strip().lower()})
+
+
+@router.post("/bulk-login", dependencies=[Depends(admit_bulk_login)])
+@claim_required("admin_bulk_login")
+async def bulk_login(request: Request):
+    """
+    Email a magic link to every row of a CSV (`email,permissions,expire_in`)
+    or JSON list in the request body. Streams NDJSON lines of
+    {"row", "email", "status"[, "error"]} as rows are stored and sent.
+    """
+    try:
+        rows = parse_bulk_rows((await request.body()).decode("utf-8"), request.headers.get("content-type", ""))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Unreadable rows: {e}")
+    if len(rows) > BULK_LOGIN_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_LOGIN_MAX} rows per request")
+    for row in rows:
+        # Only the CLI, run on the server, may hand out admin claims in bulk
+        row.permissions = requestable(row.permissions)
+
+    if mail_queue.full():
+        # Same back-pressure as the form: the provider is already behind
+        raise HTTPException(status_code=503, detail="Too many pending emails, try again shortly")
+
+    return StreamingResponse(
+        issue_logins_ndjson(request.app.state.login_tokens, rows, admit=admit_bulk_row),
+        media_type="application/x-ndjson",
+    )
+
+
+class IntrospectRequest(BaseModel):
+    tokens: List[str]
+    # Claims to decide for every token, as claim_required would
+    claims: List[str] = []
+
+
+@router.post("/introspect")
+@claim_required("admin_introspect")
+async def introspect_tokens(request: Request, body: IntrospectRequest):
+    """
+    Validate a batch of tokens for another service. Returns
+    {"results": [...]} in request order, each with "active", the decoded
+    "claims" and "permissions" (or a failure "reason"), a per-claim
+    "decisions" map and "allowed" when every claim is granted.
+    """
+    if len(body.tokens) > INTROSPECT_MAX_TOKENS:
+        raise HTTPException(status_code=400, detail=f"At most {INTROSPECT_MAX_TOKENS} tokens per request")
+    return JSONResponse({"results": await introspect(body.tokens, body.claims)})
+
+
+@router.get("/admin/slow-requests")
+@claim_required("admin_profile")
+async def slow_requests(request: Request, limit: Optional[int] = None):
+    """The most recent requests slower than PROFILE_SLOW_MS, newest first, with phases and sampled stacks."""
+    return JSONResponse({
+        "enabled": PROFILE_ENABLED,
+        "threshold_ms": PROFILE_SLOW_MS,
+        "stats": PROFILER.stats(),
+        "requests": recent(limit),
+    })
+
+
+@router.post("/revoke")
+@claim_required("admin_revoke")
+async def revoke(
+    request: Request,
+    user_id: Optional[str] = Form(None),
+    jti: Optional[str] = Form(None),
+    exp: Optional[float] = Form(None),
+):
+    """
+    Revoke every token for a `user_id` and/or the token with a `jti` until
+    `exp` (the latest expiry of the tokens concerned; defaults to
+    REVOCATION_MAX_TTL from now).
+    """
+    if REVOCATIONS is None:
+        raise HTTPException(status_code=501, detail="Revocation is disabled")
+
+    keys = revocation_keys({"user_id": user_id, "jti": jti})
+    if not keys:
+        raise HTTPException(status_code=400, detail="Give a user_id or jti to revoke")
+
+    expires_at = exp if exp is not None else time.time() + REVOCATION_MAX_TTL
+    await REVOCATIONS.revoke(keys, expires_at)
+    return JSONResponse({"revoked": keys, "expires_at": expires_at})
+
+
+@router.get("/logout", response_class=HTMLResponse)
+@claim_required("read_loggedIn")
 async def logged_in(request: Request):
+    # Revoke the token itself too, so copies of the cookie stop working
+    payload = request.state.token_payload
+    keys = revocation_keys(payload)
+    if REVOCATIONS is not None and keys:
+        expires_at = payload.get("exp") or time.time() + REVOCATION_MAX_TTL
+        if RENEWER is not None:
+            # Renewed copies share the user_id and may expire later, up to the end of the session
+            expires_at = max(expires_at, RENEWER.session_end(payload) or expires_at)
+        await REVOCATIONS.revoke(keys, expires_at)
+
     redirect_url = "/"  # your logged-in homepage
     response = RedirectResponse(url=redirect_url, status_code=302)
 
@@ -264,8 +395,63 @@ async def logged_in(request: Request):
         secure=RAILWAY_ENVIRONMENT_NAME == "production",       # only over HTTPS in real environments
         samesite="lax",
         path="/",
-        max_age=60 * 60,   # todo, match this up to the token claim
+        max_age=0,
     )
 
     return response
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Storage clients are built in the background so the worker starts serving straight away
+    warm_up = asyncio.create_task(app.state.login_tokens.open())
+    precompile()
+    await JWKS.start()
+    if REVOCATIONS is not None:
+        await REVOCATIONS.start()
+    await ROLE_POLICY.start()
+    # Startup handlers of included routers (the IdP's key sync)
+    await app.router.startup()
+    try:
+        yield
+    finally:
+        warm_up.cancel()
+        await asyncio.gather(warm_up, return_exceptions=True)
+        await app.router.shutdown()
+        await mail_queue.stop()
+        await JWKS.stop()
+        if REVOCATIONS is not None:
+            await REVOCATIONS.stop()
+        await ROLE_POLICY.stop()
+        await PROFILER.stop()
+        await app.state.login_tokens.close()
+
+
+def create_app(enable_idp: Optional[bool] = None) -> FastAPI:
+    """
+    Build the app. Heavy clients (boto3, Resend, Authlib) are imported on
+    first use, so this stays cheap; with the IdP disabled Authlib is never
+    imported at all.
+    """
+    app = FastAPI(lifespan=lifespan)
+    app.state.login_tokens = build_login_tokens()
+    app.add_middleware(JWTAuthMiddleware)
+    app.add_middleware(metrics.MetricsMiddleware)  # times the auth middleware too
+    if PROFILE_ENABLED:
+        app.add_middleware(ProfilingMiddleware)  # outermost, so Server-Timing's total covers everything
+
+    app.mount("/static", StaticFiles(directory="static"), name="static")
+    app.include_router(router)
+
+    if IDP_ENABLED if enable_idp is None else enable_idp:
+        from idp_router import KEYS as IDP_KEYS, router as idp_router
+        from idp_tokens import issuer as idp_issuer
+
+        app.include_router(idp_router, prefix="/idp", tags=["MockIdP"])
+        for mode in JWT_TRUST_MOCK_IDP:
+            JWKS.add_issuer(idp_issuer(mode), IDP_KEYS.jwks)
+    return app
+
+
+# hypercorn main:app
+app = create_app()
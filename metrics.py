@@ -0,0 +1,182 @@
+"""
+Minimal in-process metrics with Prometheus text exposition.
+
+Every metric is a plain dict keyed by label values and updated without
+locks; the GIL keeps single updates consistent and an occasionally lost
+increment from a threadpool race is an acceptable price for staying off the
+request path. Values are per process, so each Hypercorn worker reports its
+own numbers.
+"""
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from starlette.routing import Mount
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+REGISTRY: List["Metric"] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name}{labels} {_number(value)}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        return [(self.name, _labels(self.labelnames, k), v) for k, v in self._values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket..., +Inf count, sum]
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, *labels) -> "_Timer":
+        return _Timer(self, labels)
+
+    def samples(self):
+        out = []
+        for labels, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                out.append((f"{self.name}_bucket", _labels(self.labelnames, labels, f'le="{le}"'), cumulative))
+            out.append((f"{self.name}_sum", _labels(self.labelnames, labels), series[-1]))
+            out.append((f"{self.name}_count", _labels(self.labelnames, labels), cumulative))
+        return out
+
+
+class _Timer:
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class GaugeFunc(Metric):
+    """A gauge (or counter, with `type`) read from `fn` at scrape time; `fn` returns a number or {labels: number}."""
+
+    def __init__(self, name: str, help: str, fn: Callable, labelnames: Sequence[str] = (), type: str = "gauge"):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+        self.type = type
+
+    def samples(self):
+        value = self.fn()
+        if not isinstance(value, dict):
+            return [(self.name, "", value)]
+        return [(self.name, _labels(self.labelnames, k if isinstance(k, tuple) else (k,)), v) for k, v in value.items()]
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+# --- HTTP metrics ---
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "Time spent handling HTTP requests", ("method", "route", "status"),
+)
+
+
+class MetricsMiddleware:
+    """
+    Records a latency histogram per method, route template and status code.
+    Routes are labelled with their path template (e.g. /logged-in/claim/{op}/{entity})
+    so the label set stays bounded.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._routes = None
+
+    def _route_name(self, scope) -> str:
+        if self._routes is None:
+            router = scope.get("router")
+            if router is None:
+                return "unmatched"
+            self._routes = {}
+            for route in router.routes:
+                endpoint = route.app if isinstance(route, Mount) else getattr(route, "endpoint", None)
+                self._routes[id(endpoint)] = route.path
+        endpoint = scope.get("endpoint")
+        return self._routes.get(id(endpoint), "unmatched") if endpoint is not None else "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, scope["method"], self._route_name(scope), str(status))
@@ -1,30 +1,272 @@
 import jwt
 import os
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
 from jwt import InvalidTokenError
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import HTTPConnection
+
+from jwks_cache import JWKSCache
+from metrics import FAST_BUCKETS, Counter, GaugeFunc, Histogram
+from profiling import phase
+from renewal import SessionRenewer, auth_cookie
+from revocation import Revocations, SQLiteDenylist
+from token_cache import TokenCache
 
 SECRET_KEY =  os.environ.get("SECRET_KEY", "your_super_secret_key") # load from env in real life
 ALGORITHM = os.environ.get("ALGORITHM", "HS256")
+# Comma separated path prefixes that never need a token (assets, the mock IdP, ...)
+EXCLUDE_PATHS = tuple(p for p in os.environ.get("JWT_EXCLUDE_PATHS", "/static,/idp").split(",") if p)
+# Verified payloads kept in memory; set JWT_CACHE_SIZE=0 to always re-verify
+JWT_CACHE_SIZE = int(os.environ.get("JWT_CACHE_SIZE", "1024"))
+JWT_CACHE_TTL = float(os.environ.get("JWT_CACHE_TTL", "300"))
+
+TOKEN_CACHE = TokenCache(JWT_CACHE_SIZE, JWT_CACHE_TTL) if JWT_CACHE_SIZE > 0 else None
+
+# Other issuers whose (asymmetrically signed) tokens are accepted, as comma separated
+# "issuer=jwks_url" entries; without "=jwks_url" the keys are fetched from "<issuer>/jwks"
+TRUSTED_ISSUERS = dict(
+    (item.split("=", 1) if "=" in item else (item, item.rstrip("/") + "/jwks"))
+    for item in os.environ.get("JWT_TRUSTED_ISSUERS", "").split(",") if item
+)
+# Expected "aud" of issuer tokens; unset skips the audience check
+JWT_AUDIENCE = os.environ.get("JWT_AUDIENCE")
+JWT_JWKS_REFRESH = float(os.environ.get("JWT_JWKS_REFRESH", "300"))
+ASYMMETRIC_ALGORITHMS = ("RS256", "PS256", "ES256", "EdDSA")
+
+JWKS = JWKSCache(TRUSTED_ISSUERS, refresh_interval=JWT_JWKS_REFRESH)
+
+# Denylist of revoked user_ids/jtis shared by the workers on a host; "off" disables checks
+REVOCATION_STORE = os.environ.get("REVOCATION_STORE", "sqlite")
+REVOCATION_DB = os.environ.get("REVOCATION_DB", "revocations.db")
+REVOCATION_CAPACITY = int(os.environ.get("REVOCATION_CAPACITY", "100000"))
+REVOCATION_SYNC_INTERVAL = float(os.environ.get("REVOCATION_SYNC_INTERVAL", "1"))
+
+# Sliding sessions: re-sign login tokens (cookies only) this many seconds before their exp,
+# for at most JWT_SESSION_MAX_AGE seconds after the magic link was used; 0 disables renewal
+JWT_RENEW_WINDOW = float(os.environ.get("JWT_RENEW_WINDOW", "0"))
+JWT_SESSION_MAX_AGE = float(os.environ.get("JWT_SESSION_MAX_AGE", str(7 * 24 * 3600)))
+
+RENEWER = SessionRenewer(SECRET_KEY, ALGORITHM, JWT_RENEW_WINDOW, JWT_SESSION_MAX_AGE) if JWT_RENEW_WINDOW > 0 else None
+
+REVOCATIONS = None
+if REVOCATION_STORE == "sqlite":
+    REVOCATIONS = Revocations(
+        SQLiteDenylist(REVOCATION_DB), capacity=REVOCATION_CAPACITY, sync_interval=REVOCATION_SYNC_INTERVAL,
+    )
+
+JWT_DECODE_SECONDS = Histogram("jwt_decode_seconds", "Time spent verifying JWTs (cache misses only)", buckets=FAST_BUCKETS)
+JWT_DECODE_FAILURES = Counter("jwt_decode_failures_total", "JWTs rejected, by PyJWT error", ("reason",))
+if TOKEN_CACHE is not None:
+    GaugeFunc("jwt_cache_events_total", "Token cache lookups and evictions",
+              lambda: {k: v for k, v in TOKEN_CACHE.stats().items() if k in ("hits", "misses", "evictions")},
+              ("event",), type="counter")
+    GaugeFunc("jwt_cache_size", "Payloads held in the token cache", lambda: TOKEN_CACHE.stats()["size"])
+GaugeFunc("jwt_jwks", "Trusted issuer keysets and refresh counters", JWKS.stats, ("stat",))
+if REVOCATIONS is not None:
+    GaugeFunc("jwt_revocations", "Revocation filter size and checks", REVOCATIONS.stats, ("stat",))
+if RENEWER is not None:
+    GaugeFunc("jwt_renewals", "Session renewals signed, shared and refused at the session cap", RENEWER.stats, ("stat",))
+
+
+class LazyState(dict):
+    """
+    Request state whose entries can be computed on first access.
+
+    Starlette's `request.state` reads straight out of `scope["state"]`, so a
+    loader registered here only runs when a handler (or `claim_required`)
+    actually asks for the value.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._loaders = {}
+
+    def lazy(self, key, loader):
+        self.pop(key, None)
+        self._loaders[key] = loader
+
+    def __missing__(self, key):
+        loader = self._loaders.pop(key, None)
+        if loader is None:
+            raise KeyError(key)
+        value = self[key] = loader()
+        return value
+
+
+class UnknownSigningKey(InvalidTokenError):
+    """The token's issuer is trusted but its kid isn't in the cached keyset (yet)."""
+
+
+def bearer_token(scope):
+    """The token from an `Authorization: Bearer ...` header, if any."""
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            scheme, _, credentials = value.decode("latin-1").partition(" ")
+            if scheme.lower() == "bearer" and credentials.strip():
+                return credentials.strip()
+    return None
+
+
+class JWTAuthMiddleware:
+    """
+    Pure ASGI middleware attaching `request.state.token_payload`.
+
+    Requests under one of `exclude_paths` always see `None`. For everything
+    else the token (from an `Authorization: Bearer` header, or else the
+    `auth_token` cookie) is only verified the first time the payload is read,
+    and then only if `cache` doesn't already hold its payload.
 
-class JWTAuthMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        token = request.cookies.get("auth_token")
-        payload = None
+    Tokens signed with `ALGORITHM` are checked against `SECRET_KEY`; tokens
+    signed with an asymmetric algorithm must come from one of the issuers in
+    `jwks` and are checked against that issuer's key for the token's kid.
+    Verified payloads, cached or not, are then checked against `revocations`.
+
+    With a `renewer`, a cookie token whose payload the app read and found
+    valid may be swapped for a fresh one via a `Set-Cookie` on the response;
+    see `SessionRenewer`.
+    """
+
+    def __init__(self, app, exclude_paths=EXCLUDE_PATHS, cache=TOKEN_CACHE, jwks=JWKS, revocations=REVOCATIONS,
+                 renewer=RENEWER):
+        self.app = app
+        self.exclude_paths = tuple(exclude_paths)
+        self.cache = cache
+        self.jwks = jwks
+        self.revocations = revocations
+        self.renewer = renewer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        state = LazyState(scope.get("state") or {})
+        scope["state"] = state
+
+        token = cookie_token = None
+        if not scope["path"].startswith(self.exclude_paths):
+            token = bearer_token(scope)
+            if not token:
+                token = cookie_token = HTTPConnection(scope).cookies.get("auth_token")
 
         if token:
-            try:
-                payload = jwt.decode(
-                    token,
-                    SECRET_KEY,
-                    algorithms=[ALGORITHM],
-                )
-            except InvalidTokenError:
-                # Bad token – treat as unauthenticated
-                payload = None
-
-        # Attach the decoded payload (or None) to the request
-        request.state.token_payload = payload
-
-        response = await call_next(request)
-        return response
\ No newline at end of file
+            state.lazy("token_payload", lambda: self.decode(token))
+        else:
+            state["token_payload"] = None
+
+        if cookie_token and self.renewer is not None:
+            send = self._renewing(send, state, cookie_token)
+        await self.app(scope, receive, send)
+
+    def _renewing(self, send, state, token):
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                # dict.get doesn't load the payload: only requests that checked the token renew it
+                payload = state.get("token_payload")
+                headers = message.get("headers", [])
+                # Leave responses that set the cookie themselves (login, logout) alone
+                if payload is not None and not any(
+                    name == b"set-cookie" and value.startswith(b"auth_token=") for name, value in headers
+                ):
+                    with phase("renew"):
+                        renewed = self.renewer.renew(token, payload)
+                    if renewed is not None:
+                        message["headers"] = list(headers) + [(b"set-cookie", auth_cookie(*renewed).encode("latin-1"))]
+            await send(message)
+
+        return send_wrapper
+
+    def decode(self, token):
+        return self.check(token)[0]
+
+    def check(self, token) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """
+        (payload, None) for a valid token, or (None, reason) where reason is
+        the PyJWT error name (e.g. "ExpiredSignatureError") or "Revoked".
+        """
+        with phase("jwt"):
+            return self._checked(*self._decode(token))
+
+    def _checked(self, payload, reason) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        if payload is not None and self.revocations is not None and self.revocations.is_revoked(payload):
+            JWT_DECODE_FAILURES.inc("Revoked")
+            return None, "Revoked"
+        return payload, reason
+
+    async def check_many(self, tokens: Iterable[str], chunk_size: int = 64) -> Dict[str, Tuple]:
+        """
+        `check` for a batch of tokens, keyed by token; duplicates are checked
+        once. Cached payloads are answered straight away and the rest are
+        verified in the threadpool, `chunk_size` per job, so a large batch
+        doesn't hold up the event loop.
+        """
+        results, misses = {}, []
+        for token in dict.fromkeys(tokens):
+            payload = self.cache.get(token) if self.cache is not None else None
+            if payload is None:
+                misses.append(token)
+            else:
+                results[token] = self._checked(payload, None)
+
+        def verify(chunk):
+            # These already missed the cache above: go straight to verification
+            with phase("jwt"):
+                return [(token, self._checked(*self._verified(token))) for token in chunk]
+
+        # One job at a time: verification holds the GIL, so parallel jobs would only
+        # crowd out the event loop without finishing any sooner
+        for i in range(0, len(misses), chunk_size):
+            results.update(await run_in_threadpool(verify, misses[i:i + chunk_size]))
+        return results
+
+    def _decode(self, token):
+        if self.cache is not None:
+            payload = self.cache.get(token)
+            if payload is not None:
+                return payload, None
+        return self._verified(token)
+
+    def _verified(self, token):
+        """Verify `token` (a cache miss) and cache its payload."""
+        start = time.perf_counter()
+        try:
+            payload = self._verify(token)
+        except InvalidTokenError as e:
+            # Bad token – treat as unauthenticated
+            JWT_DECODE_FAILURES.inc(type(e).__name__)
+            return None, type(e).__name__
+        finally:
+            JWT_DECODE_SECONDS.observe(time.perf_counter() - start)
+
+        if self.cache is not None:
+            self.cache.set(token, payload)
+        return payload, None
+
+    def _verify(self, token):
+        if not self.jwks:
+            return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+
+        unverified = jwt.decode_complete(token, options={"verify_signature": False})
+        alg = unverified["header"].get("alg")
+        if alg == ALGORITHM:
+            return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        if alg not in ASYMMETRIC_ALGORITHMS:
+            raise jwt.InvalidAlgorithmError(f"Algorithm {alg!r} is not allowed")
+
+        iss = unverified["payload"].get("iss")
+        if iss not in self.jwks.issuers:
+            raise jwt.InvalidIssuerError(f"Untrusted issuer {iss!r}")
+        key = self.jwks.get(iss, unverified["header"].get("kid"))
+        if key is None:
+            raise UnknownSigningKey(f"No key for kid {unverified['header'].get('kid')!r} from {iss}")
+
+        # Only the algorithm the JWK was published for, so a key can't be used with another alg
+        return jwt.decode(
+            token,
+            key.key,
+            algorithms=[key.algorithm_name],
+            issuer=iss,
+            audience=JWT_AUDIENCE,
+            options={"verify_aud": JWT_AUDIENCE is not None},
+        )
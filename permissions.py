@@ -0,0 +1,352 @@
+import asyncio
+import base64
+import json
+import os
+from fnmatch import fnmatchcase
+from functools import lru_cache
+from itertools import combinations
+from types import MappingProxyType
+from typing import Any, Dict, FrozenSet, Iterable, List, Mapping, Optional, Sequence, Set
+
+from starlette.concurrency import run_in_threadpool
+
+from metrics import GaugeFunc
+
+# Token claim holding the compact form: "<registry version>.<base64url bitset>"
+COMPACT_CLAIM = "pbits"
+
+
+class PermissionRegistry:
+    """
+    Maps claim names to bit positions for the compact token encoding.
+
+    Bit positions are part of every token issued with this registry, so only
+    ever append claims. Removing or reordering claims needs a new version,
+    and the old registry must stay in `REGISTRIES` until its tokens expire.
+    """
+
+    def __init__(self, version: int, claims: Sequence[str]):
+        self.version = version
+        self.claims = tuple(claims)
+        self.bits = {claim: 1 << i for i, claim in enumerate(self.claims)}
+
+    def mask(self, claims: Iterable[str]) -> int:
+        """Bitmask of `claims`; claims this registry doesn't know are ignored."""
+        mask = 0
+        for claim in claims:
+            mask |= self.bits.get(claim, 0)
+        return mask
+
+    def names(self, bits: int) -> FrozenSet[str]:
+        return frozenset(claim for claim, bit in self.bits.items() if bits & bit)
+
+    def encode(self, bits: int) -> str:
+        raw = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+        return f"{self.version}." + base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+    @staticmethod
+    def decode_bits(encoded: str) -> int:
+        return int.from_bytes(base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4)), "little")
+
+
+REGISTRIES = {
+    1: PermissionRegistry(1, ["read_loggedIn", "read_foo", "write_foo", "read_bar", "write_bar"]),
+}
+REGISTRY = REGISTRIES[max(REGISTRIES)]
+
+
+class PermissionSet(frozenset):
+    """
+    The permissions granted by a token: a frozenset of readable claim names
+    plus their bitset in the current `REGISTRY`, whatever form the token
+    carried them in, so required claims can be checked with one mask.
+    """
+
+    __slots__ = ("bits",)
+
+    def __new__(cls, names: Iterable[str] = (), bits: Optional[int] = None):
+        self = super().__new__(cls, names)
+        self.bits = REGISTRY.mask(self) if bits is None else bits
+        return self
+
+    def has_all(self, mask: int, others: Iterable[str] = ()) -> bool:
+        """
+        True if every claim in `mask` (from `REGISTRY.mask`) and every claim
+        in `others` (those the registry doesn't know) is granted.
+        """
+        return self.bits & mask == mask and all(claim in self for claim in others)
+
+    def readable(self) -> str:
+        return ",".join(sorted(self))
+
+
+EMPTY = PermissionSet()
+
+# Claims guarding admin endpoints. Nobody can ask for these on the sign-up form or in a bulk
+# API row, and other issuers' tokens never grant them; they only come from `python -m logins`
+RESERVED_CLAIM_PREFIX = "admin_"
+
+
+def requestable(claims: Iterable[str]) -> List[str]:
+    """`claims` without the reserved ones, for permissions a caller picks for a token."""
+    return [claim for claim in claims if not claim.startswith(RESERVED_CLAIM_PREFIX)]
+
+# --- ROLES ---
+# Declarative role -> claim policy, e.g. {"roles": {"editor": {"inherits": ["viewer"], "claims": ["write_*"]}}}
+ROLE_POLICY_FILE = os.environ.get("ROLE_POLICY_FILE", "roles.json")
+# Seconds between checks of the policy file for changes; 0 only reads it at startup
+ROLE_POLICY_RELOAD = float(os.environ.get("ROLE_POLICY_RELOAD", "5"))
+
+# Claims endpoints require through claim_required (see `declare_claims`), for wildcards to match
+DECLARED_CLAIMS: Set[str] = set()
+
+
+class RoleTable:
+    """
+    A compiled role policy: every role's claims with inheritance and
+    wildcards already expanded, and the union for every combination of
+    roles, so a token's roles turn into a `PermissionSet` with one dict
+    lookup. Immutable; a changed policy compiles into a new table.
+
+    Wildcards (`read_*`, `*`) are matched against the claims the policy can
+    know about: the permission registry, the claims declared by
+    `claim_required`, every plain claim named in the policy, and the
+    policy's optional top-level `claims` list.
+    """
+
+    # All combinations are precomputed up to this many roles (2**n entries)
+    PRECOMPUTE_MAX_ROLES = 10
+
+    def __init__(self, policy: Mapping[str, Any]):
+        roles = policy.get("roles", {})
+        if not isinstance(roles, dict):
+            raise ValueError("'roles' must be an object of role name -> {inherits, claims}")
+        for name, spec in roles.items():
+            unknown = [parent for parent in spec.get("inherits", []) if parent not in roles]
+            if unknown:
+                raise ValueError(f"Role {name!r} inherits unknown roles {unknown}")
+
+        known = set(REGISTRY.claims) | DECLARED_CLAIMS | set(policy.get("claims", []))
+        for spec in roles.values():
+            known.update(claim for claim in spec.get("claims", []) if "*" not in claim)
+
+        self.roles: Mapping[str, PermissionSet] = MappingProxyType(
+            {name: PermissionSet(self._closure(name, roles, known, ())) for name in roles}
+        )
+        self._table: Dict[FrozenSet[str], PermissionSet] = {}
+        names = sorted(self.roles)
+        if len(names) <= self.PRECOMPUTE_MAX_ROLES:
+            for size in range(len(names) + 1):
+                for combo in combinations(names, size):
+                    self._table[frozenset(combo)] = self._union(combo)
+
+    @classmethod
+    def _closure(cls, name: str, roles, known, seen: tuple) -> FrozenSet[str]:
+        if name in seen:
+            raise ValueError(f"Role inheritance cycle: {' -> '.join(seen + (name,))}")
+        claims = set()
+        for pattern in roles[name].get("claims", []):
+            if "*" in pattern:
+                claims.update(claim for claim in known if fnmatchcase(claim, pattern))
+            else:
+                claims.add(pattern)
+        for parent in roles[name].get("inherits", []):
+            claims |= cls._closure(parent, roles, known, seen + (name,))
+        return frozenset(claims)
+
+    def _union(self, roles: Iterable[str]) -> PermissionSet:
+        sets = [self.roles[role] for role in roles if role in self.roles]
+        if not sets:
+            return EMPTY
+        if len(sets) == 1:
+            return sets[0]
+        bits = 0
+        for granted in sets:
+            bits |= granted.bits
+        return PermissionSet(frozenset().union(*sets), bits)
+
+    def lookup(self, roles: FrozenSet[str]) -> PermissionSet:
+        granted = self._table.get(roles)
+        if granted is None:
+            # Unknown role names grant nothing; large policies fill the table on demand
+            granted = self._union(roles)
+            if len(self._table) < 4096:
+                self._table[roles] = granted
+        return granted
+
+
+class RolePolicy:
+    """
+    The live `RoleTable` for `path`. A background task re-reads the file
+    when its mtime changes and swaps in a freshly compiled table; a broken
+    edit is logged and the previous table stays in force.
+    """
+
+    def __init__(self, path: Optional[str], reload_interval: float = ROLE_POLICY_RELOAD):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.reloads = 0
+        self.errors = 0
+        self._mtime = None
+        self._task: Optional[asyncio.Task] = None
+        self._policy: Mapping[str, Any] = {}
+        self.table = RoleTable({})
+        self.reload()
+
+    def reload(self) -> bool:
+        """Recompile if the file changed (blocking). Returns True if the table was replaced."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns if self.path else None
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return False
+        # A broken edit is reported once, not on every check until it is fixed
+        self._mtime = mtime
+        try:
+            if mtime is None:
+                policy = {}
+            else:
+                with open(self.path) as f:
+                    policy = json.load(f)
+            table = RoleTable(policy)
+        except (OSError, ValueError, AttributeError, TypeError) as e:
+            print("Error loading role policy", self.path, e)
+            self.errors += 1
+            return False
+        self._policy, self.table = policy, table
+        self.reloads += 1
+        return True
+
+    def recompile(self) -> None:
+        """Compile the current policy again, e.g. after more claims were declared."""
+        self.table = RoleTable(self._policy)
+
+    def lookup(self, roles: Iterable[str]) -> PermissionSet:
+        return self.table.lookup(frozenset(roles))
+
+    async def start(self) -> None:
+        if self.path and self.reload_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await run_in_threadpool(self.reload)
+            except Exception as e:
+                print("Error reloading role policy:", e)
+
+    def stats(self) -> Dict[str, int]:
+        return {"roles": len(self.table.roles), "reloads": self.reloads, "errors": self.errors}
+
+
+ROLE_POLICY = RolePolicy(ROLE_POLICY_FILE)
+GaugeFunc("role_policy", "Compiled roles and policy reload counters", ROLE_POLICY.stats, ("stat",))
+
+
+def declare_claims(claims: Iterable[str]) -> None:
+    """
+    Make `claims` known to role wildcards, so `admin_*` grants a new
+    endpoint's claim without editing the policy. Called by claim_required
+    as routes are defined.
+    """
+    new = set(claims) - DECLARED_CLAIMS
+    if new:
+        DECLARED_CLAIMS.update(new)
+        ROLE_POLICY.recompile()
+
+
+def encode_permissions(claims: Iterable[str], registry: PermissionRegistry = REGISTRY) -> Dict[str, str]:
+    """
+    Token claims for `claims` in the compact form. Anything the registry
+    doesn't know stays in the readable `permissions` claim.
+    """
+    claims = list(dict.fromkeys(claims))
+    encoded = {COMPACT_CLAIM: registry.encode(registry.mask(claims))}
+    leftover = [claim for claim in claims if claim not in registry.bits]
+    if leftover:
+        encoded["permissions"] = ",".join(leftover)
+    return encoded
+
+
+@lru_cache(maxsize=1024)
+def _from_compact(value: str) -> PermissionSet:
+    version, _, encoded = value.partition(".")
+    registry = REGISTRIES.get(int(version)) if version.isdigit() else None
+    if registry is None:
+        return EMPTY
+    try:
+        bits = registry.decode_bits(encoded)
+    except ValueError:
+        return EMPTY
+    if registry is REGISTRY:
+        return PermissionSet(registry.names(bits), bits)
+    return PermissionSet(registry.names(bits))
+
+
+@lru_cache(maxsize=1024)
+def _from_string(raw: str) -> PermissionSet:
+    return PermissionSet(p.strip() for p in raw.split(",") if p.strip())
+
+
+def parse_permissions(payload: Optional[Any]) -> PermissionSet:
+    """
+    Turn the permission claims of a decoded token into a `PermissionSet`.
+
+    Tokens minted by `request_login` carry a comma joined `permissions`
+    string, a compact `pbits` bitset, or both (claims the registry doesn't
+    know stay readable). A JSON list is accepted as well so hand-made tokens
+    keep working. ID tokens carry `roles` instead, which `ROLE_POLICY`
+    expands with a single table lookup. Parsed strings are cached, since the
+    same tokens come back request after request.
+
+    Tokens from other issuers (anything with an `iss`) never grant reserved
+    claims, whatever their roles or permissions say: only the app's own
+    tokens, minted by an admin path, can carry them.
+    """
+    if not isinstance(payload, dict):
+        return EMPTY
+    if "iss" in payload:
+        return _unreserved(_granted(payload))
+    return _granted(payload)
+
+
+def _granted(payload: Dict[str, Any]) -> PermissionSet:
+
+    compact = payload.get(COMPACT_CLAIM)
+    granted = _from_compact(compact) if isinstance(compact, str) else EMPTY
+
+    roles = payload.get("roles")
+    if roles and isinstance(roles, list):
+        granted = _merge(granted, ROLE_POLICY.lookup(role for role in roles if isinstance(role, str)))
+
+    raw = payload.get("permissions")
+    if not raw:
+        return granted
+    if isinstance(raw, str):
+        names = _from_string(raw)
+    else:
+        names = PermissionSet(p.strip() for p in raw if isinstance(p, str) and p.strip())
+    return _merge(granted, names)
+
+
+@lru_cache(maxsize=1024)
+def _unreserved(permissions: PermissionSet) -> PermissionSet:
+    if not any(claim.startswith(RESERVED_CLAIM_PREFIX) for claim in permissions):
+        return permissions
+    return PermissionSet(requestable(permissions))
+
+
+def _merge(a: PermissionSet, b: PermissionSet) -> PermissionSet:
+    if b is EMPTY or b <= a:
+        return a
+    if a is EMPTY:
+        return b
+    return PermissionSet(a | b, a.bits | b.bits)
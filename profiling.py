@@ -0,0 +1,227 @@
+"""
+Opt-in per-request phase timing and slow-request profiles.
+
+With PROFILE_ENABLED=1, `ProfilingMiddleware` gives every request a
+`Trace`. Code on the request path marks its phases with `phase("name")`;
+their durations go out in a `Server-Timing` header. While a request has
+been running longer than PROFILE_SLOW_MS, a sampler thread records the
+stacks of every thread every PROFILE_SAMPLE_INTERVAL seconds; when it
+finishes, its phases and aggregated stacks are kept in a ring buffer of the
+PROFILE_RING_SIZE most recent slow requests (see `recent`).
+
+When profiling is off, or a request is fast, `phase` costs one ContextVar
+lookup and the sampler does nothing but check whether anything is slow.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "0") == "1"
+PROFILE_SLOW_MS = float(os.environ.get("PROFILE_SLOW_MS", "500"))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_RING_SIZE = int(os.environ.get("PROFILE_RING_SIZE", "50"))
+# Innermost frames kept per sampled stack
+PROFILE_STACK_DEPTH = 40
+
+
+class Trace:
+    __slots__ = ("method", "path", "start", "phases", "samples", "done")
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+        self.phases: List[tuple] = []
+        self.samples: Counter = Counter()
+        self.done = False
+
+    def server_timing(self, total: float) -> str:
+        totals: Dict[str, float] = {}
+        for name, seconds in self.phases:
+            totals[name] = totals.get(name, 0.0) + seconds
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in totals.items()]
+        entries.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(entries)
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar("profiling_trace", default=None)
+
+
+class _Phase:
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        # Tasks started during a request inherit its context; don't let them write to it afterwards
+        if not self.trace.done:
+            self.trace.phases.append((self.name, time.perf_counter() - self.start))
+
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+def phase(name: str):
+    """Time a block as phase `name` of the current request, if it is being traced."""
+    trace = _current.get()
+    if trace is None:
+        return _NO_PHASE
+    return _Phase(trace, name)
+
+
+def _folded(frame, thread_name: str) -> str:
+    names = []
+    while frame is not None and len(names) < PROFILE_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    names.append(thread_name)
+    return ";".join(reversed(names))
+
+
+class Profiler:
+    """
+    Tracks in-flight traces, samples stacks for the ones over `slow_ms`, and
+    keeps the last `ring_size` slow requests.
+    """
+
+    def __init__(self, slow_ms: float = PROFILE_SLOW_MS, interval: float = PROFILE_SAMPLE_INTERVAL,
+                 ring_size: int = PROFILE_RING_SIZE):
+        self.slow = slow_ms / 1000
+        self.interval = interval
+        self.recent = deque(maxlen=ring_size)
+        self.traced = 0
+        self.slow_requests = 0
+        self.samples = 0
+        self._active: Dict[int, Trace] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def begin(self, method: str, path: str) -> Trace:
+        self.start()
+        trace = Trace(method, path)
+        self._active[id(trace)] = trace
+        self.traced += 1
+        return trace
+
+    def end(self, trace: Trace, status: int) -> float:
+        trace.done = True
+        self._active.pop(id(trace), None)
+        elapsed = time.perf_counter() - trace.start
+        if elapsed >= self.slow:
+            self.slow_requests += 1
+            self.recent.append({
+                "at": time.time() - elapsed,
+                "method": trace.method,
+                "path": trace.path,
+                "status": status,
+                "duration_ms": round(elapsed * 1000, 2),
+                "phases": [{"name": name, "ms": round(seconds * 1000, 3)} for name, seconds in trace.phases],
+                "stack_samples": sum(trace.samples.values()),
+                "stacks": [{"stack": stack, "count": count} for stack, count in trace.samples.most_common(20)],
+            })
+        return elapsed
+
+    # --- Stack sampling ---
+
+    def _sample(self) -> None:
+        now = time.perf_counter()
+        slow = [trace for trace in list(self._active.values()) if now - trace.start >= self.slow]
+        if not slow:
+            return
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        me = threading.get_ident()
+        stacks = [_folded(frame, names.get(ident, str(ident)))
+                  for ident, frame in sys._current_frames().items() if ident != me]
+        self.samples += 1
+        for trace in slow:
+            trace.samples.update(stacks)
+
+    def _run(self) -> None:
+        while not self._stopping.wait(self.interval):
+            try:
+                self._sample()
+            except Exception as e:
+                print("Error sampling stacks:", e)
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+
+    async def stop(self) -> None:
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join(1)
+            self._thread = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "traced": self.traced,
+            "slow": self.slow_requests,
+            "samples": self.samples,
+            "in_flight": len(self._active),
+            "kept": len(self.recent),
+        }
+
+
+PROFILER = Profiler()
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware tracing each HTTP request and adding `Server-Timing`."""
+
+    def __init__(self, app, profiler: Profiler = PROFILER):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = self.profiler.begin(scope["method"], scope["path"])
+        token = _current.set(trace)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                # Phases that finish after the headers go out (streamed bodies) only show up in the profile
+                timing = trace.server_timing(time.perf_counter() - trace.start)
+                message["headers"] = list(message.get("headers", [])) + [(b"server-timing", timing.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            self.profiler.end(trace, status)
+
+
+def recent(limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """The most recent slow requests, newest first."""
+    traces = list(PROFILER.recent)[::-1]
+    return traces[:limit] if limit else traces
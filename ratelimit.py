@@ -0,0 +1,210 @@
+import math
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+from metrics import Counter, GaugeFunc
+from sqlite_local import LocalConnection
+
+# "sqlite" shares buckets between the workers on a host; "memory" keeps them per worker
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE", "sqlite")
+RATE_LIMIT_DB = os.environ.get("RATE_LIMIT_DB", "ratelimit.db")
+# Trust the last X-Forwarded-For entry (the one our own proxy appended) as the client address
+RATE_LIMIT_TRUST_FORWARDED = os.environ.get("RATE_LIMIT_TRUST_FORWARDED", "0") == "1"
+
+RATE_LIMIT_REJECTIONS = Counter("rate_limit_rejections_total", "Requests refused with 429", ("endpoint", "reason"))
+
+
+class Rule:
+    """A token bucket: `burst` requests at once, refilled at `count` per `period` seconds."""
+
+    def __init__(self, count: float, period: float, burst: Optional[float] = None):
+        self.rate = count / period
+        self.burst = burst if burst is not None else count
+
+    @classmethod
+    def parse(cls, spec: str) -> Optional["Rule"]:
+        """"10/60" is 10 requests per 60 seconds; "" or "0" disables the rule."""
+        if not spec or spec == "0":
+            return None
+        count, _, period = spec.partition("/")
+        return cls(float(count), float(period or 1))
+
+    def refill(self, tokens: float, elapsed: float) -> float:
+        return min(self.burst, tokens + elapsed * self.rate)
+
+    def full_at(self, tokens: float, at: float) -> float:
+        """When a bucket holding `tokens` at `at` is full again, and can be forgotten."""
+        return at + (self.burst - tokens) / self.rate
+
+
+def _take(rules: List[Tuple[str, Rule]], buckets: Dict[str, Tuple[float, float]], now: float):
+    """
+    Take one token from every bucket, or from none of them. Returns the
+    updated buckets, or None plus the seconds until all of them would allow
+    a request and the key of the bucket that needs longest.
+    """
+    updated = {}
+    retry_after, limited_by = 0.0, None
+    for key, rule in rules:
+        tokens, at = buckets.get(key, (rule.burst, now))
+        tokens = rule.refill(tokens, now - at)
+        if tokens < 1 and (1 - tokens) / rule.rate > retry_after:
+            retry_after, limited_by = (1 - tokens) / rule.rate, key
+        updated[key] = (tokens - 1, now)
+    if limited_by is not None:
+        return None, retry_after, limited_by
+    return updated, 0.0, None
+
+
+class MemoryBuckets:
+    """Per-worker buckets; each Hypercorn worker enforces the limits on its own."""
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._full_at: Dict[str, float] = {}
+
+    async def take(self, rules: List[Tuple[str, Rule]]) -> Tuple[float, Optional[str]]:
+        now = time.monotonic()
+        updated, retry_after, limited_by = _take(rules, self._buckets, now)
+        if updated is not None:
+            if len(self._buckets) >= self.max_keys:
+                # Full buckets can be forgotten without changing anything; each has its own rule's refill time
+                self._full_at = {k: t for k, t in self._full_at.items() if t > now}
+                self._buckets = {k: v for k, v in self._buckets.items() if k in self._full_at}
+            self._buckets.update(updated)
+            for key, rule in rules:
+                self._full_at[key] = rule.full_at(*updated[key])
+        return retry_after, limited_by
+
+
+class SQLiteBuckets:
+    """
+    Buckets in a WAL-mode SQLite file, so every worker on the host draws
+    from the same buckets. Each check is one short IMMEDIATE transaction.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connect = LocalConnection(path)
+        self._writes = 0
+        with self._connect() as db:
+            columns = [row[1] for row in db.execute("PRAGMA table_info(buckets)")]
+            if columns and "full_at" not in columns:
+                # Buckets from before full_at was stored; losing them only refills them
+                db.execute("DROP TABLE buckets")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                " key TEXT PRIMARY KEY,"
+                " tokens REAL NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " full_at REAL NOT NULL)"
+            )
+
+    def _take_sync(self, rules: List[Tuple[str, Rule]]) -> Tuple[float, Optional[str]]:
+        now = time.time()
+        keys = [key for key, _ in rules]
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute(
+                f"SELECT key, tokens, updated_at FROM buckets WHERE key IN ({','.join('?' * len(keys))})", keys
+            ).fetchall()
+            updated, retry_after, limited_by = _take(rules, {key: (tokens, at) for key, tokens, at in rows}, now)
+            if updated is not None:
+                db.executemany(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated_at, full_at) VALUES (?, ?, ?, ?)",
+                    [(key, *updated[key], rule.full_at(*updated[key])) for key, rule in rules],
+                )
+                self._writes += 1
+                if self._writes % 1000 == 0:
+                    # Only buckets that have refilled under their own rule, however long its period
+                    db.execute("DELETE FROM buckets WHERE full_at <= ?", (now,))
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return retry_after, limited_by
+
+    async def take(self, rules: List[Tuple[str, Rule]]) -> Tuple[float, Optional[str]]:
+        return await run_in_threadpool(self._take_sync, rules)
+
+
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.rsplit(",", 1)[-1].strip()
+    return request.client.host if request.client else "unknown"
+
+
+class Admission:
+    """
+    Admission control for one expensive endpoint: at most `max_concurrency`
+    requests in flight in this worker, and token buckets per key kind
+    (e.g. {"ip": Rule(10, 60), "email": Rule(3, 300)}).
+
+    `admit` answers a rejected request with a 429 and a Retry-After header
+    before any of the endpoint's own work starts; an admitted request must
+    call `release` when done. Use it through a FastAPI dependency with
+    `yield`, so release happens even if the endpoint fails.
+    """
+
+    def __init__(self, name: str, buckets, rules: Dict[str, Optional[Rule]], max_concurrency: int = 0):
+        self.name = name
+        self.buckets = buckets
+        self.rules = {kind: rule for kind, rule in rules.items() if rule is not None}
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        GaugeFunc(f"{name}_in_flight", f"Requests being handled by {name}", lambda: self.in_flight)
+
+    def _reject(self, reason: str, retry_after: float) -> HTTPException:
+        RATE_LIMIT_REJECTIONS.inc(self.name, reason)
+        return HTTPException(
+            status_code=429,
+            detail="Too many requests, try again later",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+    def _keyed(self, keys: Dict[str, str]) -> List[Tuple[str, Rule]]:
+        return [(f"{self.name}:{kind}:{keys[kind]}", rule) for kind, rule in self.rules.items() if keys.get(kind)]
+
+    async def admit(self, keys: Dict[str, str]) -> None:
+        if self.max_concurrency and self.in_flight >= self.max_concurrency:
+            raise self._reject("concurrency", 1)
+        self.in_flight += 1
+        try:
+            rules = self._keyed(keys)
+            if rules:
+                retry_after, limited_by = await self.buckets.take(rules)
+                if limited_by is not None:
+                    # Labelled with the key kind ("ip", "email"), never the value
+                    raise self._reject(limited_by.split(":")[1], retry_after)
+        except BaseException:
+            self.in_flight -= 1
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+
+    async def allows(self, keys: Dict[str, str]) -> bool:
+        """
+        Take from the buckets for `keys` only, without a concurrency slot, for
+        work done on someone's behalf (e.g. each row of a bulk request).
+        False, counted as a rejection, if any of them is empty.
+        """
+        rules = self._keyed(keys)
+        if not rules:
+            return True
+        _, limited_by = await self.buckets.take(rules)
+        if limited_by is not None:
+            RATE_LIMIT_REJECTIONS.inc(self.name, limited_by.split(":")[1])
+            return False
+        return True
+
+
+BUCKETS = SQLiteBuckets(RATE_LIMIT_DB) if RATE_LIMIT_STORE == "sqlite" else MemoryBuckets()
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.cookies import SimpleCookie
+from typing import Any, Dict, Optional, Tuple
+
+import jwt
+
+# Attributes shared by every auth_token cookie the app sets
+COOKIE_SECURE = os.environ.get("RAILWAY_ENVIRONMENT_NAME") == "production"
+
+
+def token_max_age(exp: Any, now: Optional[float] = None) -> int:
+    """Seconds until `exp`, for a cookie that should expire with its token."""
+    if not isinstance(exp, (int, float)):
+        return 0
+    return max(0, int(exp - (time.time() if now is None else now)))
+
+
+def auth_cookie(token: str, max_age: int) -> str:
+    """A `Set-Cookie` value for the auth_token cookie, as `proxy_jwt` sets it."""
+    cookie = SimpleCookie()
+    cookie["auth_token"] = token
+    cookie["auth_token"]["path"] = "/"
+    cookie["auth_token"]["max-age"] = max_age
+    cookie["auth_token"]["samesite"] = "lax"
+    if COOKIE_SECURE:
+        cookie["auth_token"]["httponly"] = True
+        cookie["auth_token"]["secure"] = True
+    return cookie.output(header="").strip()
+
+
+class SessionRenewer:
+    """
+    Sliding renewal of the app's own login tokens.
+
+    A token inside `window` seconds of its `exp` is re-signed with the same
+    claims and its original lifetime (`exp - iat`), but never past
+    `auth_time + max_age`, the absolute session lifetime; `auth_time` is the
+    `iat` of the token the magic link handed out and is carried over.
+
+    Each renewal is remembered until the old token expires, so concurrent
+    requests presenting the same token all get the one replacement instead
+    of signing a token each.
+    """
+
+    def __init__(self, secret: str, algorithm: str, window: float, max_age: float, max_size: int = 4096):
+        self.secret = secret
+        self.algorithm = algorithm
+        self.window = window
+        self.max_age = max_age
+        self.max_size = max_size
+        self.renewed = 0
+        self.reused = 0
+        self.capped = 0
+        self._recent: "OrderedDict[bytes, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def renew(self, token: str, payload: Dict[str, Any]) -> Optional[Tuple[str, int]]:
+        """(new token, cookie max_age) if `token` is due for renewal, else None."""
+        exp, iat = payload.get("exp"), payload.get("iat")
+        # Tokens from trusted issuers, and ones minted before iat was set, are left alone
+        if "iss" in payload or not isinstance(exp, (int, float)) or not isinstance(iat, (int, float)):
+            return None
+        now = time.time()
+        if exp - now > self.window:
+            return None
+
+        key = hashlib.sha256(token.encode("utf-8")).digest()
+        with self._lock:
+            entry = self._recent.get(key)
+            if entry is not None:
+                self.reused += 1
+                return entry[1], token_max_age(entry[2], now)
+
+        auth_time = payload.get("auth_time", iat)
+        new_exp = min(int(now) + (exp - iat), auth_time + self.max_age)
+        if new_exp <= exp:
+            self.capped += 1
+            return None
+
+        claims = dict(payload, iat=int(now), exp=new_exp, auth_time=auth_time)
+        renewed = jwt.encode(claims, self.secret, algorithm=self.algorithm)
+
+        with self._lock:
+            self.renewed += 1
+            self._sweep(now)
+            self._recent[key] = (exp, renewed, new_exp)
+            while len(self._recent) > self.max_size:
+                self._recent.popitem(last=False)
+        return renewed, token_max_age(new_exp, now)
+
+    def session_end(self, payload: Dict[str, Any]) -> Optional[float]:
+        """The latest `exp` any renewal of this token's session can reach."""
+        start = payload.get("auth_time", payload.get("iat"))
+        if not isinstance(start, (int, float)):
+            return None
+        return start + self.max_age
+
+    def _sweep(self, now: float) -> None:
+        # Renewals arrive in roughly exp order; stop at the first live one and let max_size bound the rest
+        while self._recent:
+            key, entry = next(iter(self._recent.items()))
+            if entry[0] > now:
+                break
+            del self._recent[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "renewed": self.renewed,
+            "reused": self.reused,
+            "capped": self.capped,
+            "pending": len(self._recent),
+        }
@@ -0,0 +1,216 @@
+import asyncio
+import hashlib
+import math
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from sqlite_local import LocalConnection
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings. `in` never misses a key that was
+    added; it answers True for other keys with probability ~`error_rate`
+    while holding no more than `capacity` keys.
+    """
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        # Double hashing: k positions from the two halves of one 128-bit digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str) -> None:
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        bits, size = self._bits, self.size
+        # Stop at the first clear bit: keys that were never added usually miss on the first probe
+        for i in range(self.hashes):
+            pos = (h1 + i * h2) % size
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class SQLiteDenylist:
+    """
+    The authoritative list of revoked keys, in a WAL-mode SQLite file shared
+    by every worker on the host. Each entry lives until `expires_at`, the
+    `exp` of the newest token it can match. `seq` grows with every new
+    entry so workers can fetch just what they haven't seen.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._connect = LocalConnection(path)
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS revoked ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " key TEXT NOT NULL UNIQUE,"
+                " expires_at REAL NOT NULL)"
+            )
+
+    def add(self, keys: Iterable[str], expires_at: float) -> None:
+        db = self._connect()
+        db.executemany(
+            "INSERT INTO revoked (key, expires_at) VALUES (?, ?)"
+            " ON CONFLICT(key) DO UPDATE SET expires_at = max(expires_at, excluded.expires_at)",
+            [(key, expires_at) for key in keys],
+        )
+
+    def contains(self, key: str, now: float) -> bool:
+        row = self._connect().execute(
+            "SELECT 1 FROM revoked WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        return row is not None
+
+    def since(self, seq: int) -> List[Tuple[int, str]]:
+        return self._connect().execute(
+            "SELECT seq, key FROM revoked WHERE seq > ? ORDER BY seq", (seq,)
+        ).fetchall()
+
+    def purge(self, now: float) -> int:
+        return self._connect().execute("DELETE FROM revoked WHERE expires_at <= ?", (now,)).rowcount
+
+
+def revocation_keys(payload: Dict[str, Any]) -> List[str]:
+    """The denylist keys a token can be revoked under."""
+    keys = []
+    if payload.get("user_id"):
+        keys.append(f"user_id:{payload['user_id']}")
+    if payload.get("jti"):
+        keys.append(f"jti:{payload['jti']}")
+    return keys
+
+
+class Revocations:
+    """
+    Revocation checks for `JWTAuthMiddleware`.
+
+    Every key in the denylist is also in an in-memory Bloom filter, so the
+    usual case (token not revoked) costs one hash and a few bit tests; only
+    a filter hit reads the denylist. A background task adds other workers'
+    revocations to the filter every `sync_interval` seconds, and rebuilds
+    it from scratch every `rebuild_interval` seconds to drop expired keys.
+    """
+
+    def __init__(
+        self,
+        store: SQLiteDenylist,
+        capacity: int = 100000,
+        error_rate: float = 0.001,
+        sync_interval: float = 1,
+        rebuild_interval: float = 600,
+    ):
+        self.store = store
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self.rebuild_interval = rebuild_interval
+
+        self.checks = 0
+        self.filter_hits = 0
+        self.revoked_hits = 0
+
+        self._filter = BloomFilter(capacity, error_rate)
+        self._seq = 0
+        self._task: Optional[asyncio.Task] = None
+
+    # --- Request path ---
+
+    def is_revoked(self, payload: Dict[str, Any]) -> bool:
+        self.checks += 1
+        for key in revocation_keys(payload):
+            if key in self._filter:
+                self.filter_hits += 1
+                if self.store.contains(key, time.time()):
+                    self.revoked_hits += 1
+                    return True
+        return False
+
+    # --- Revoking ---
+
+    async def revoke(self, keys: List[str], expires_at: float) -> None:
+        await run_in_threadpool(self.store.add, keys, expires_at)
+        for key in keys:
+            self._filter.add(key)
+
+    # --- Keeping the filter in sync ---
+    # Store reads run in the threadpool; the live filter is only ever
+    # modified on the event loop.
+
+    async def sync(self) -> int:
+        """Add keys revoked since the last sync (by any worker). Returns how many."""
+        rows = await run_in_threadpool(self.store.since, self._seq)
+        for seq, key in rows:
+            self._filter.add(key)
+            self._seq = max(self._seq, seq)
+        return len(rows)
+
+    def _build(self) -> Tuple[BloomFilter, int]:
+        self.store.purge(time.time())
+        fresh = BloomFilter(self.capacity, self.error_rate)
+        rows = self.store.since(0)
+        for _, key in rows:
+            fresh.add(key)
+        return fresh, rows[-1][0] if rows else 0
+
+    async def rebuild(self) -> None:
+        """
+        Purge expired entries and swap in a filter built from what is left.
+        Anything revoked while it was being built has a later seq, so the
+        next `sync` adds it.
+        """
+        fresh, seq = await run_in_threadpool(self._build)
+        self._filter = fresh
+        self._seq = seq
+
+    async def start(self) -> None:
+        if self._task is None:
+            await self.rebuild()
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def run(self) -> None:
+        next_rebuild = time.monotonic() + self.rebuild_interval
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                if time.monotonic() >= next_rebuild:
+                    await self.rebuild()
+                    next_rebuild = time.monotonic() + self.rebuild_interval
+                else:
+                    await self.sync()
+            except Exception as e:
+                print("Error syncing revocations:", e)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "filter_keys": self._filter.count,
+            "checks": self.checks,
+            "filter_hits": self.filter_hits,
+            "revoked_hits": self.revoked_hits,
+        }
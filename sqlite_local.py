@@ -0,0 +1,25 @@
+import sqlite3
+import threading
+
+
+class LocalConnection:
+    """
+    Per-thread connections to a SQLite file in WAL mode, for the stores
+    shared by every worker on a host. Calling it returns this thread's
+    connection, opened on first use in autocommit mode (callers issue their
+    own BEGIN IMMEDIATE where they read-modify-write).
+    """
+
+    def __init__(self, path: str, timeout: float = 5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def __call__(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
@@ -0,0 +1,118 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import jinja2
+from fastapi.responses import HTMLResponse
+from fastapi.templating import Jinja2Templates
+
+from metrics import GaugeFunc
+from profiling import phase
+
+TEMPLATE_DIR = os.environ.get("TEMPLATE_DIR", "templates")
+# Re-check template files for changes on every render (handy while editing them)
+TEMPLATE_AUTO_RELOAD = os.environ.get("TEMPLATE_AUTO_RELOAD", "0") == "1"
+# Directory for compiled template bytecode, shared by workers; unset to disable
+TEMPLATE_BYTECODE_CACHE = os.environ.get("TEMPLATE_BYTECODE_CACHE")
+TEMPLATE_RENDER_CACHE_SIZE = int(os.environ.get("TEMPLATE_RENDER_CACHE_SIZE", "64"))
+
+
+def _bytecode_cache() -> Optional[jinja2.BytecodeCache]:
+    if not TEMPLATE_BYTECODE_CACHE:
+        return None
+    os.makedirs(TEMPLATE_BYTECODE_CACHE, exist_ok=True)
+    return jinja2.FileSystemBytecodeCache(TEMPLATE_BYTECODE_CACHE)
+
+
+# The one template environment for the whole app
+templates = Jinja2Templates(
+    directory=TEMPLATE_DIR,
+    auto_reload=TEMPLATE_AUTO_RELOAD,
+    bytecode_cache=_bytecode_cache(),
+)
+
+
+def precompile() -> int:
+    """Load every template now rather than on its first request. Returns how many were compiled."""
+    env = templates.env
+    names = env.list_templates(extensions=["html"])
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+
+class RenderCache:
+    """
+    Rendered bytes of pages that don't depend on the request, keyed by
+    template name and context. Bounded LRU; `invalidate` drops a template's
+    entries (or everything) after its source or inputs change.
+    """
+
+    def __init__(self, max_size: int = TEMPLATE_RENDER_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(name: str, context: Dict[str, Any]) -> tuple:
+        return (name, tuple(sorted((k, _freeze(v)) for k, v in context.items())))
+
+    def render(self, name: str, context: Dict[str, Any]) -> bytes:
+        if self.max_size <= 0 or TEMPLATE_AUTO_RELOAD:
+            return templates.get_template(name).render(context).encode("utf-8")
+
+        key = self.key(name, context)
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return body
+
+        self.misses += 1
+        body = templates.get_template(name).render(context).encode("utf-8")
+        with self._lock:
+            self._entries[key] = body
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return body
+
+    def invalidate(self, name: Optional[str] = None) -> None:
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == name]:
+                    del self._entries[key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+render_cache = RenderCache()
+GaugeFunc("template_render_cache", "Rendered-page cache size and lookups", render_cache.stats, ("stat",))
+
+
+def static_page(name: str, status_code: int = 200, **context) -> HTMLResponse:
+    """
+    A response for a template whose output only depends on `context`.
+    Templates rendered this way never see the request, so they must not use it.
+    """
+    with phase("render"):
+        return HTMLResponse(render_cache.render(name, context), status_code=status_code)
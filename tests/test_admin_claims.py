@@ -0,0 +1,54 @@
+import asyncio
+import os
+import tempfile
+
+_tmp = tempfile.mkdtemp()
+os.environ.update({
+    "JWT_TRUST_MOCK_IDP": "persona,expert",
+    "IDP_KEYS_FILE": os.path.join(_tmp, "idp_keys.json"),
+    "REVOCATION_DB": os.path.join(_tmp, "revocations.db"),
+    "RATE_LIMIT_DB": os.path.join(_tmp, "ratelimit.db"),
+    "LOGIN_TOKEN_STORE": "memory",
+})
+os.makedirs("static", exist_ok=True)
+
+import main  # noqa: E402
+from benchmarks.asgi import call  # noqa: E402
+from idp_router import PERSONAS, sign_for_mode  # noqa: E402
+from idp_tokens import id_token_payload  # noqa: E402
+from middleware import JWKS  # noqa: E402
+
+
+def _id_token(mode, claims):
+    token = sign_for_mode(mode, id_token_payload(mode, claims))
+    # The app's lifespan isn't run here: load the IdP's keys the way the JWKS refresher would
+    JWKS.refresh()
+    return token
+
+
+def _revoke(token):
+    status, _, _ = asyncio.run(call(
+        main.app, "POST", "/revoke",
+        headers=[("authorization", f"Bearer {token}")], form={"user_id": "someone-else"},
+    ))
+    return status
+
+
+def test_idp_admin_persona_cannot_revoke():
+    token = _id_token("persona", PERSONAS["admin"])
+    assert _revoke(token) == 403
+
+
+def test_idp_viewer_is_authenticated():
+    # Same path as the cases below, but allowed through to the claim check
+    status, _, _ = asyncio.run(call(
+        main.app, "GET", "/logged-in",
+        headers=[("authorization", f"Bearer {_id_token('persona', PERSONAS['default'])}")],
+    ))
+    assert status == 200
+
+
+def test_idp_expert_mode_cannot_claim_admin_permissions():
+    claims = {"sub": "expert-1", "roles": ["admin"], "permissions": "admin_revoke,read_loggedIn"}
+    token = _id_token("expert", claims)
+    assert _revoke(token) == 403